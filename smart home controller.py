@@ -1,7 +1,595 @@
 import flet as ft
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qs
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import bisect
+import codecs
+import hashlib
+import heapq
+import hmac
+import ipaddress
+import itertools
 import json
+import operator
+import os
 import random
+import struct
+import threading
+import time
+import types
+import zlib
+
+# Fixed action kinds of the columnar log; the two 'Set' kinds carry a value
+LOG_ACTIONS = ['Turn ON', 'Turn OFF', 'Lock', 'Unlock', 'Enable', 'Disable', 'Set to ', 'Set speed to ']
+SET_TEMPERATURE, SET_SPEED = 6, 7
+# A device command is logged when requested and again with its outcome
+LOG_STATUSES = ['requested', 'confirmed', 'failed']
+
+def new_log_store(entries=()):
+    # Columnar action log, oldest entry first: epoch times in a typed array,
+    # device/room/user as codes into one interned string table, and actions as
+    # LOG_ACTIONS codes plus a value (codes past LOG_ACTIONS index free-form actions)
+    store = {
+        'time': array('d'),
+        'device': array('I'),
+        'room': array('I'),
+        'user': array('I'),
+        'action': array('H'),
+        'value': array('f'),
+        'status': array('b'),
+        'strings': [],
+        'codes': {},
+        'actions': [],
+        'action_codes': {},
+    }
+    for entry in sorted(entries, key=lambda entry: entry['time']):
+        log_store_append(store, entry['time'], entry['device'], entry['room'], entry['user'], entry['action'],
+                         LOG_STATUSES.index(entry.get('status', 'requested')))
+    return store
+
+def intern_string(store, text):
+    code = store['codes'].get(text)
+    if code is None:
+        code = store['codes'][text] = len(store['strings'])
+        store['strings'].append(text)
+    return code
+
+def encode_action(store, action):
+    if action in LOG_ACTIONS[:SET_TEMPERATURE]:
+        return LOG_ACTIONS.index(action), 0.0
+    try:
+        if action.startswith('Set to ') and action.endswith('°C'):
+            value = float(action[len('Set to '):-len('°C')])
+            if f"Set to {value:.1f}°C" == action:
+                return SET_TEMPERATURE, value
+        elif action.startswith('Set speed to '):
+            value = int(action[len('Set speed to '):])
+            if f"Set speed to {value}" == action:
+                return SET_SPEED, value
+    except ValueError:
+        pass
+    code = store['action_codes'].get(action)
+    if code is None:
+        code = store['action_codes'][action] = len(LOG_ACTIONS) + len(store['actions'])
+        store['actions'].append(action)
+    return code, 0.0
+
+def decode_action(store, code, value):
+    if code == SET_TEMPERATURE:
+        return f"Set to {value:.1f}°C"
+    if code == SET_SPEED:
+        return f"Set speed to {int(value)}"
+    if code < len(LOG_ACTIONS):
+        return LOG_ACTIONS[code]
+    return store['actions'][code - len(LOG_ACTIONS)]
+
+def log_store_append(store, when, device_id, room, user, action, status=0):
+    code, value = encode_action(store, action)
+    store['time'].append(when.timestamp() if isinstance(when, datetime) else when)
+    store['device'].append(intern_string(store, device_id))
+    store['room'].append(intern_string(store, room))
+    store['user'].append(intern_string(store, user))
+    store['action'].append(code)
+    store['value'].append(value)
+    store['status'].append(status)
+
+def log_store_len(store):
+    return len(store['time'])
+
+def log_store_row(store, index):
+    # Rows are only materialized as dicts for display and export
+    strings = store['strings']
+    return {
+        'time': datetime.fromtimestamp(store['time'][index]),
+        'device': strings[store['device'][index]],
+        'action': decode_action(store, store['action'][index], store['value'][index]),
+        'user': strings[store['user'][index]],
+        'room': strings[store['room'][index]],
+        'status': LOG_STATUSES[store['status'][index]],
+    }
+
+def log_store_rows(store, device=None, room=None, user=None, limit=None, newest_first=True):
+    # Filters compare integer codes, so non-matching rows are never materialized
+    columns = []
+    for column, text in (('device', device), ('room', room), ('user', user)):
+        if text is not None:
+            if text not in store['codes']:
+                return
+            columns.append((store[column], store['codes'][text]))
+    
+    indexes = range(log_store_len(store) - 1, -1, -1) if newest_first else range(log_store_len(store))
+    found = 0
+    for index in indexes:
+        for values, code in columns:
+            if values[index] != code:
+                break
+        else:
+            yield log_store_row(store, index)
+            found += 1
+            if limit is not None and found >= limit:
+                return
+
+def log_store_drop_oldest(store, count):
+    for column in LOG_COLUMNS:
+        del store[column][:count]
+
+def log_store_users(store):
+    return sorted(store['strings'][code] for code in set(store['user']))
+
+LOG_COLUMNS = ('time', 'device', 'room', 'user', 'action', 'value', 'status')
+
+def log_store_merge(store, rows):
+    # rows: encoded column tuples sorted by time. Only stored rows inside the time span
+    # of the new rows are merged in Python; the rest move with one slice assignment
+    if not rows:
+        return
+    times = store['time']
+    start = bisect.bisect_right(times, rows[0][0])
+    end = bisect.bisect_right(times, rows[-1][0], start)
+    overlap = list(zip(*(store[column][start:end] for column in LOG_COLUMNS)))
+    merged = list(heapq.merge(overlap, rows, key=lambda row: row[0])) if overlap else rows
+    for column, values in zip(LOG_COLUMNS, zip(*merged)):
+        store[column][start:end] = array(store[column].typecode, values)
+
+def iter_json_array(f, chunk_size=1 << 20):
+    # Yields (item, bytes read so far) from a binary file holding one JSON array,
+    # keeping only one chunk and the item being decoded in memory
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer, position, bytes_read = "", 0, 0
+    started = eof = False
+    while True:
+        # Skip whitespace, the opening bracket and the commas between items
+        while position < len(buffer) and (buffer[position].isspace() or buffer[position] == ','
+                                          or (not started and buffer[position] == '[')):
+            started = started or buffer[position] == '['
+            position += 1
+        if position < len(buffer) and started and buffer[position] == ']':
+            return
+        if position < len(buffer) and started:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = None  # item continues in the next chunk
+            if end is not None and (end < len(buffer) or eof):
+                position = end
+                yield item, bytes_read
+                continue
+        elif position < len(buffer):
+            raise ValueError("Expected a JSON array")
+        if eof:
+            return
+        chunk = f.read(chunk_size)
+        bytes_read += len(chunk)
+        eof = not chunk
+        buffer = buffer[position:] + text_decoder.decode(chunk, final=eof)
+        position = 0
+
+# Camera thumbnails are produced once per frame and shared by every session
+CAMERA_SIZES = {'card': (256, 144), 'details': (640, 360)}
+camera_config = {
+    'card_fps': 1,  # wanted by overview and room cards
+    'details_fps': 5,  # wanted by an open details page
+    'fps_budget': 20,  # frames per second across all cameras being watched
+    'viewer_timeout': 2.0,  # seconds before a session that stopped polling no longer counts
+    'cache_bytes': 16 * 1024 * 1024,
+    'workers': 2,
+}
+camera_sources = {}
+thumbnail_cache = {
+    'entries': OrderedDict(),  # (source, frame, size) -> base64 PNG, least recently used first
+    'bytes': 0,
+    'latest': {},  # (source, size) -> newest cached key
+    'pending': set(),  # (source, frame) being produced
+    'viewers': {},  # source -> {session: (fps, size, last seen)}
+    'lock': threading.Lock(),
+    'hits': 0,
+    'frames': 0,
+    'frame_ms': 0.0,
+}
+frame_pool = ThreadPoolExecutor(max_workers=camera_config['workers'], thread_name_prefix='camera')
+
+def register_camera_source(scheme, read_frame):
+    # read_frame(location, now) -> (width, height, RGB bytes)
+    camera_sources[scheme] = read_frame
+
+def synthetic_frame(location, now, width=640, height=360):
+    # Test stand-in: a gradient with a bar that sweeps across once every four seconds
+    seed = sum(location.encode())
+    bar_x = int((now % 4) / 4 * (width - 40))
+    bar = bytes((255, 255, 255)) * 40
+    rows = []
+    for y in range(height):
+        shade = y * 200 // height
+        row = bytes(((seed * 7 + shade) % 256, (seed * 13) % 256, 55 + shade)) * width
+        rows.append(row[:bar_x * 3] + bar + row[(bar_x + 40) * 3:])
+    return width, height, b''.join(rows)
+
+def read_ppm_frame(location, now):
+    # Binary PPM (P6) file, or a directory of them played back at one frame per second
+    if os.path.isdir(location):
+        names = sorted(name for name in os.listdir(location) if name.endswith('.ppm'))
+        if not names:
+            raise ValueError(f"No .ppm frames in {location}")
+        location = os.path.join(location, names[int(now) % len(names)])
+    with open(location, 'rb') as f:
+        data = f.read()
+    fields, position = [], 0
+    while len(fields) < 4:
+        while position < len(data) and data[position:position + 1].isspace():
+            position += 1
+        if position >= len(data):
+            raise ValueError(f"{location} has a truncated PPM header")
+        if data[position:position + 1] == b'#':
+            position = data.index(b'\n', position)
+            continue
+        end = position
+        while end < len(data) and not data[end:end + 1].isspace():
+            end += 1
+        fields.append(data[position:end])
+        position = end
+    if fields[0] != b'P6' or int(fields[3]) > 255:
+        raise ValueError(f"{location} is not an 8-bit binary PPM")
+    width, height = int(fields[1]), int(fields[2])
+    pixels = data[position + 1:position + 1 + width * height * 3]
+    if width <= 0 or height <= 0 or len(pixels) < width * height * 3:
+        raise ValueError(f"{location} is missing pixel data")
+    return width, height, pixels
+
+register_camera_source('synthetic', synthetic_frame)
+register_camera_source('ppm', read_ppm_frame)
+
+def resize_frame(width, height, pixels, target):
+    # Nearest-neighbour downscale by a whole-pixel step, one slice per channel and row
+    step = max(1, -(-width // target[0]), -(-height // target[1]))
+    out_width = len(range(0, width, step))
+    rows = []
+    for y in range(0, height, step):
+        row = pixels[y * width * 3:(y + 1) * width * 3]
+        out = bytearray(out_width * 3)
+        for channel in range(3):
+            out[channel::3] = row[channel::3 * step]
+        rows.append(bytes(out))
+    return out_width, len(rows), rows
+
+def encode_png(width, height, rows):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    raw = b''.join(b'\x00' + row for row in rows)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+PLACEHOLDER_THUMBNAIL = base64.b64encode(encode_png(1, 1, [bytes((17, 24, 39))])).decode()
+
+def watch_camera(source, session, fps, size):
+    with thumbnail_cache['lock']:
+        thumbnail_cache['viewers'].setdefault(source, {})[session] = (fps, size, time.monotonic())
+
+def unwatch_session(session):
+    # Drops everything a closed session was watching, so its cameras stop counting right away
+    with thumbnail_cache['lock']:
+        viewers = thumbnail_cache['viewers']
+        for source in list(viewers):
+            viewers[source].pop(session, None)
+            if not viewers[source]:
+                del viewers[source]
+
+def get_camera_fps(source):
+    # The fastest rate any current viewer wants, limited by the budget shared by watched cameras
+    now = time.monotonic()
+    with thumbnail_cache['lock']:
+        viewers = thumbnail_cache['viewers']
+        for watched in list(viewers):
+            for session, (_, _, seen) in list(viewers[watched].items()):
+                if now - seen > camera_config['viewer_timeout']:
+                    del viewers[watched][session]
+            if not viewers[watched]:
+                del viewers[watched]
+        if source not in viewers:
+            return 0
+        wanted = max(fps for fps, _, _ in viewers[source].values())
+        return min(wanted, camera_config['fps_budget'] / len(viewers))
+
+def produce_thumbnails(source, frame, sizes, now):
+    started = time.perf_counter()
+    scheme, _, location = source.partition(':')
+    results = {}
+    try:
+        width, height, pixels = camera_sources[scheme](location, now)
+        results = {size: base64.b64encode(encode_png(*resize_frame(width, height, pixels, CAMERA_SIZES[size]))).decode()
+                   for size in sizes}
+    except (KeyError, OSError, ValueError):
+        pass
+    finally:
+        # Whatever happened, the frame may be requested again
+        with thumbnail_cache['lock']:
+            thumbnail_cache['pending'].discard((source, frame))
+    with thumbnail_cache['lock']:
+        entries = thumbnail_cache['entries']
+        for size, encoded in results.items():
+            key = (source, frame, size)
+            entries[key] = encoded
+            thumbnail_cache['bytes'] += len(encoded)
+            latest = thumbnail_cache['latest'].get((source, size))
+            if latest is None or latest[1] < frame:
+                thumbnail_cache['latest'][(source, size)] = key
+        while thumbnail_cache['bytes'] > camera_config['cache_bytes'] and entries:
+            _, dropped = entries.popitem(last=False)
+            thumbnail_cache['bytes'] -= len(dropped)
+        thumbnail_cache['frames'] += 1
+        thumbnail_cache['frame_ms'] = (time.perf_counter() - started) * 1000
+
+def get_thumbnail(source, size):
+    # Returns the newest cached thumbnail at once and queues the next frame if one is due
+    fps = get_camera_fps(source)
+    now = time.time()
+    with thumbnail_cache['lock']:
+        latest = thumbnail_cache['latest'].get((source, size))
+        if latest in thumbnail_cache['entries']:
+            thumbnail_cache['entries'].move_to_end(latest)
+            thumbnail_cache['hits'] += 1
+            encoded = thumbnail_cache['entries'][latest]
+        else:
+            latest, encoded = None, None
+        if fps:
+            frame = int(now * fps) / fps
+            if (latest is None or latest[1] < frame) and (source, frame) not in thumbnail_cache['pending']:
+                thumbnail_cache['pending'].add((source, frame))
+                sizes = {watched_size for _, watched_size, _ in thumbnail_cache['viewers'].get(source, {}).values()}
+                frame_pool.submit(produce_thumbnails, source, frame, sizes | {size}, now)
+    return latest, encoded
+
+# Accounts store salted PBKDF2 hashes; logging in pays for the slow hash once and
+# returns a signed session token that later requests are checked against
+users_db = {
+    'admin': {'password': "pbkdf2_sha256$200000$KUNYxgF7H18lmM/NQbAmaA==$PSU6BMmkozsSQQrgxrW29ycNNazWt/r9cot7jMedaO0=",
+              'role': 'admin'},
+    'user': {'password': "pbkdf2_sha256$200000$qFjwZip8LhKQJzzSpLnMhA==$4SSIwa5ladFpqIE9pvR1pEbVGv0m+qCAajuameWQoMM=",
+             'role': 'user'},
+    'guest': {'password': "pbkdf2_sha256$200000$ut2Thbaln2Ez7jH9tQK4+g==$PhbjAa9wtIgihGgBNqZvZ2Q5HmHYyAOtl3Mxogma9HU=",
+              'role': 'guest'},
+}
+ROLE_PERMISSIONS = {
+    'admin': {'view', 'control', 'manage'},
+    'user': {'view', 'control'},
+    'guest': {'view'},
+}
+auth_config = {
+    'iterations': 200000,
+    'token_ttl': 8 * 3600,  # seconds
+    'cache_size': 4096,  # verified sessions kept in memory
+    'secret': os.urandom(32),  # tokens do not survive a restart
+}
+session_cache = {
+    'entries': OrderedDict(),  # token -> session, least recently used first
+    'revoked': {},  # token -> expiry
+    'lock': threading.Lock(),
+}
+
+def hash_password(password, salt=None, iterations=None):
+    salt = salt or os.urandom(16)
+    iterations = iterations or auth_config['iterations']
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+def verify_password(password, stored):
+    try:
+        _, iterations, salt, _ = stored.split('$')
+        expected = hash_password(password, base64.b64decode(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected, stored)
+
+# Checked against for unknown users, so they cost one hash like a wrong password does
+DUMMY_PASSWORD_HASH = hash_password("", b'\0' * 16)
+
+def authenticate(username, password):
+    # Returns a new session token, or None; unknown users cost the same as wrong passwords
+    if not isinstance(username, str) or not isinstance(password, str):
+        return None
+    user = users_db.get(username)
+    stored = user['password'] if user else DUMMY_PASSWORD_HASH
+    if not verify_password(password, stored) or not user:
+        return None
+    expires = time.time() + auth_config['token_ttl']
+    payload = base64.urlsafe_b64encode(
+        json.dumps([username, user['role'], expires, base64.b64encode(os.urandom(9)).decode()]).encode()
+    ).decode()
+    signature = base64.urlsafe_b64encode(hmac.new(auth_config['secret'], payload.encode(), 'sha256').digest()).decode()
+    token = f"{payload}.{signature}"
+    cache_session(token, {'username': username, 'role': user['role'], 'expires': expires})
+    return token
+
+def cache_session(token, session):
+    with session_cache['lock']:
+        session_cache['entries'][token] = session
+        while len(session_cache['entries']) > auth_config['cache_size']:
+            session_cache['entries'].popitem(last=False)
+
+def verify_session(token):
+    # Cached sessions cost one dict lookup; others are checked by signature and cached
+    if not token:
+        return None
+    now = time.time()
+    with session_cache['lock']:
+        session = session_cache['entries'].get(token)
+        if session:
+            if session['expires'] > now:
+                session_cache['entries'].move_to_end(token)
+                return session
+            del session_cache['entries'][token]
+            return None
+        if token in session_cache['revoked']:
+            return None
+    payload, _, signature = token.partition('.')
+    expected = base64.urlsafe_b64encode(hmac.new(auth_config['secret'], payload.encode(), 'sha256').digest()).decode()
+    if not hmac.compare_digest(expected, signature):
+        return None
+    try:
+        username, role, expires, _ = json.loads(base64.urlsafe_b64decode(payload))
+    except ValueError:
+        return None
+    if expires <= now:
+        return None
+    session = {'username': username, 'role': role, 'expires': expires}
+    cache_session(token, session)
+    return session
+
+def revoke_session(token):
+    with session_cache['lock']:
+        session = session_cache['entries'].pop(token, None)
+        now = time.time()
+        for revoked, expires in list(session_cache['revoked'].items()):
+            if expires <= now:
+                del session_cache['revoked'][revoked]
+        session_cache['revoked'][token] = session['expires'] if session else now + auth_config['token_ttl']
+
+def has_permission(session, permission):
+    return bool(session) and permission in ROLE_PERMISSIONS.get(session['role'], ())
+
+def new_search_index(devices=None):
+    # Sorted (token, device id) pairs over lowercased ids, name words and room words,
+    # so a prefix is one bisect away
+    index = {'entries': [], 'tokens': {}, 'names': {}}
+    if devices:
+        search_index_add(index, devices)
+    return index
+
+def search_tokens(device_id, device):
+    words = f"{device.get('name', '')} {device.get('room', '')}".lower().replace('_', ' ').split()
+    return {device_id.lower(), *words}
+
+def search_index_add(index, devices):
+    added = []
+    for device_id, device in devices.items():
+        if device_id in index['tokens']:
+            continue
+        tokens = search_tokens(device_id, device)
+        index['tokens'][device_id] = tokens
+        index['names'][device_id] = device.get('name', device_id)
+        added.extend((token, device_id) for token in tokens)
+    entries = index['entries']
+    if len(added) > len(entries) // 8:
+        entries.extend(added)
+        entries.sort()
+    else:
+        for entry in added:
+            bisect.insort(entries, entry)
+
+def search_index_query(index, query, limit=8):
+    # Every query word must prefix some token of the device; the narrowest word drives the scan
+    words = query.lower().replace('_', ' ').split()
+    if not words:
+        return []
+    entries = index['entries']
+    ranges = []
+    for word in words:
+        start = bisect.bisect_left(entries, (word,))
+        end = bisect.bisect_left(entries, (word + '\uffff',), start)
+        ranges.append((end - start, start, end, word))
+    _, start, end, driver = min(ranges)
+    others = [word for word in words if word != driver]
+    matches = []
+    for position in range(start, end):
+        device_id = entries[position][1]
+        if device_id in matches:
+            continue
+        tokens = index['tokens'][device_id]
+        if all(any(token.startswith(word) for token in tokens) for word in others):
+            matches.append(device_id)
+            if len(matches) >= limit:
+                break
+    return [(device_id, index['names'][device_id]) for device_id in matches]
+
+def new_heatmap():
+    # Usage counters bucketed by day of week x hour of day (index weekday * 24 + hour)
+    return {'actions': array('I', [0] * 168), 'on_seconds': array('d', [0.0] * 168)}
+
+def new_property(property_id, name, devices, automation_rules=None, action_log=None):
+    # A property shard: its own device registry, action log, automation rules
+    # and energy store, maintained by a dedicated worker thread
+    return {
+        'id': property_id,
+        'name': name,
+        'devices': devices,
+        'action_log': new_log_store(action_log or []),
+        'automation_rules': automation_rules if automation_rules is not None else [],
+        # Energy data for charts (simulated hourly consumption)
+        'energy_data': [random.randint(50, 200) for _ in range(24)],
+        'energy_samples': {'hour': None, 'total': 0.0, 'count': 0},
+        # Compacted history: (device_id, hour_start) -> counts and state durations
+        'log_aggregates': {},
+        # device_id -> hour starts that have an aggregate bucket, so summaries skip other devices
+        'aggregate_index': {},
+        # Last compacted entry per device, used to close open state durations
+        'last_compacted': {},
+        # Bumped by every compaction, so the state saver only re-serializes history that changed
+        'compactions': 0,
+        'saved_history': None,
+        'lock': threading.RLock(),
+        # Rule id -> date it last fired
+        'fired_rules': {},
+        # Device id -> command awaiting acknowledgement, and last confirmed state
+        'pending': {},
+        'confirmed': {},
+        # Bumped on every device state or rule change; keys the forecast cache
+        'revision': 0,
+        'forecast': None,
+        # Device id -> (inputs, weighted watts per forecast slot) from its heatmap, dropped when the heatmap changes
+        'profile_rows': {},
+        'dry_run': None,
+        # Usage heatmaps by device and by room, since when they have been counting,
+        # and when each active device turned on
+        'heatmaps': {'devices': {}, 'rooms': {}},
+        'heatmaps_since': time.time(),
+        # Prefix index for the device picker, extended as devices are registered
+        'search': new_search_index(devices),
+        'active_since': {},
+        # Rolling per-device statistics for anomaly detection, one array slot per device
+        'anomaly': {
+            'devices': [],
+            'power_mean': array('d'), 'power_var': array('d'), 'power_samples': array('I'),
+            'on_since': array('d'),
+            'duration_mean': array('d'), 'duration_var': array('d'), 'duration_samples': array('I'),
+            'flags': array('B'),
+            'elapsed_ms': 0.0,
+        },
+        # Times of warnings raised for this property
+        'alerts': [],
+        'stopped': False,
+        # Precomputed by the worker for the portfolio dashboard
+        'summary': {'devices': len(devices), 'active': 0, 'power': 0, 'alerts': 0, 'updated': None},
+    }
+
+# Shared by every session of the process: the property shards, the notification feed and
+# the state of the background workers. The first session starts the workers; later ones attach
+shared_state = {'lock': threading.Lock(), 'started': False}
 
 def main(page: ft.Page):
     page.title = "Smart Home Controller Pro"
@@ -9,35 +597,158 @@ def main(page: ft.Page):
     page.theme_mode = ft.ThemeMode.LIGHT
     
     # Global state
-    current_user = {'username': 'User', 'role': 'admin'}
+    current_user = {'username': None, 'role': None, 'token': None}
     dark_mode = ft.Ref[ft.Switch]()
     
-    # Device state with rooms
-    devices = {
-        'light1': {'name': 'Living Room Light', 'type': 'light', 'state': False, 'room': 'Living Room', 'power': 60},
-        'light2': {'name': 'Bedroom Light', 'type': 'light', 'state': False, 'room': 'Bedroom', 'power': 40},
-        'door1': {'name': 'Front Door', 'type': 'door', 'state': True, 'room': 'Entrance', 'power': 5},
-        'camera1': {'name': 'Front Camera', 'type': 'camera', 'state': True, 'room': 'Entrance', 'power': 10},
-        'fan1': {'name': 'Bedroom Fan', 'type': 'fan', 'value': 0, 'room': 'Bedroom', 'power': 75},
-        'thermostat1': {'name': 'Living Room Thermostat', 'type': 'thermostat', 'value': 22.0, 'room': 'Living Room', 'power': 150},
+    # Properties by id, shared by all sessions; each session's UI works on its active one
+    properties = shared_state.setdefault('properties', {
+        'home': new_property(
+            'home',
+            'My Home',
+            # Device state with rooms
+            {
+                'light1': {'name': 'Living Room Light', 'type': 'light', 'state': False, 'room': 'Living Room', 'power': 60},
+                'light2': {'name': 'Bedroom Light', 'type': 'light', 'state': False, 'room': 'Bedroom', 'power': 40},
+                'door1': {'name': 'Front Door', 'type': 'door', 'state': True, 'room': 'Entrance', 'power': 5},
+                'camera1': {'name': 'Front Camera', 'type': 'camera', 'state': True, 'room': 'Entrance', 'power': 10},
+                'fan1': {'name': 'Bedroom Fan', 'type': 'fan', 'value': 0, 'room': 'Bedroom', 'power': 75},
+                'thermostat1': {'name': 'Living Room Thermostat', 'type': 'thermostat', 'value': 22.0, 'room': 'Living Room', 'power': 150},
+            },
+            # Automation rules
+            automation_rules=[
+                {'id': 1, 'name': 'Evening Lights', 'time': '18:00', 'device': 'light1', 'action': 'Turn ON', 'enabled': True},
+                {'id': 2, 'name': 'Night Mode', 'time': '22:00', 'device': 'light1', 'action': 'Turn OFF', 'enabled': True},
+            ],
+            # Action log with more details
+            action_log=[
+                {'time': datetime.now() - timedelta(hours=2), 'device': 'light1', 'action': 'Turn ON', 'user': 'admin', 'room': 'Living Room'}
+            ],
+        ),
+    })
+    active_property = {'id': 'home'}
+    shard_config = {
+        'tick_interval': 2.0,  # seconds between property worker passes
+        'alert_window': timedelta(hours=24),
     }
     
-    # Action log with more details
-    action_log = [
-        {'time': datetime.now() - timedelta(hours=2), 'device': 'light1', 'action': 'Turn ON', 'user': 'admin', 'room': 'Living Room'}
-    ]
+    # Power and on-time anomaly detection, evaluated on every worker tick
+    anomaly_config = {
+        'power_alpha': 0.01,  # EWMA weight of each power sample taken while active
+        'duration_alpha': 0.2,  # EWMA weight of each completed on-period
+        'threshold': 3.0,  # standard deviations above the mean
+        'min_power_delta': 10,  # watts above the mean before power is unusual
+        'min_power_ratio': 1.5,  # ... and times the mean
+        'power_warmup': 30,  # active samples before power is judged
+        'duration_warmup': 5,  # on-periods before a device's own history is used
+        'min_on_hours': 1,
+        'max_on_hours': {'light': 10, 'fan': 24},  # limits until there is history; other types are always on
+    }
     
-    # Automation rules
-    automation_rules = [
-        {'id': 1, 'name': 'Evening Lights', 'time': '18:00', 'device': 'light1', 'action': 'Turn ON', 'enabled': True},
-        {'id': 2, 'name': 'Night Mode', 'time': '22:00', 'device': 'light1', 'action': 'Turn OFF', 'enabled': True},
-    ]
+    # The active property's state, rebound by switch_property()
+    devices = properties['home']['devices']
+    action_log = properties['home']['action_log']
+    automation_rules = properties['home']['automation_rules']
+    energy_data = properties['home']['energy_data']
+    log_aggregates = properties['home']['log_aggregates']
+    log_lock = properties['home']['lock']
     
     # Notifications
-    notifications = []
+    notifications = shared_state.setdefault('notifications', [])
+    
+    # Log retention: raw entries are kept for 'raw_days', then compacted into
+    # per-device, per-hour aggregates which are kept for 'aggregate_days'
+    retention = {
+        'raw_days': 7,
+        'aggregate_days': 365,
+        'compact_interval': 3600,  # seconds between background compactions
+        'max_notifications': 50,
+    }
+    # Notifications trimmed from the list are not kept, only counted by type
+    dropped_notifications = shared_state.setdefault('dropped_notifications', {'info': 0, 'success': 0, 'warning': 0})
+    
+    # Local control API (HTTP + WebSocket on localhost)
+    api_config = {
+        'enabled': True,
+        'host': '127.0.0.1',
+        'port': 8765,
+        'max_body': 1024 * 1024,
+        'default_property': 'home',  # used by routes without a /properties/<id> prefix
+        'ui_sync_interval': 0.5,  # seconds between UI refreshes for API changes and command outcomes
+        # Routes that take long enough to stall other connections run on a worker thread
+        'executor_routes': ('/automation/dry-run', '/login'),
+    }
+    # WebSocket subscribers as (event loop, queue, device filter) tuples
+    state_subscribers = shared_state.setdefault('state_subscribers', [])
+    # Property id -> changes to render; each session's UI sync re-renders when its property's count moves
+    api_state = shared_state.setdefault('api_state', {'renders': {}})
+    
+    # Device commands are applied optimistically, then acknowledged or retried and reverted
+    command_config = {
+        'max_attempts': 3,
+        'retry_backoff': 0.5,  # seconds, doubled on each retry
+        'latency': (0.05, 0.4),  # simulated round trip range in seconds
+        'failure_rate': 0.05,  # simulated chance that one attempt fails
+    }
+    command_state = shared_state.setdefault('command_state', {'tasks': [], 'sequence': itertools.count(),
+                                                              'condition': threading.Condition()})
+    # Pluggable transport: send(shard, command, on_result) must call on_result(shard, command, ok)
+    device_transport = shared_state.setdefault('device_transport', {'send': None})
+    
+    # State persisted across restarts
+    state_config = {
+        'path': 'smart_home_state.json',
+        'save_interval': 60,  # seconds
+    }
+    
+    # Energy forecast for the next 24 hours
+    forecast_config = {
+        'hours': 24,
+        'history_weight': 0.3,  # blend of the hour-of-day usage profile into the schedule projection
+    }
+    
+    # Importing action_log_*.json exports back into a property's log
+    import_config = {
+        'batch_size': 5000,  # rows inserted per lock acquisition
+        'chunk_size': 1 << 20,  # bytes read at a time
+    }
+    import_state = {'running': False, 'progress': 0.0, 'status': "", 'controls': {}}
+    
+    # Live camera thumbnails shown in this session: (property, device, slot) -> image control
+    camera_views = {}
+    camera_session = f"session-{id(page)}"
+    # Set when the page disconnects; this session's own workers exit on it
+    session_state = {'stopped': False}
+    
+    # Search-as-you-type device picker
+    device_search_config = {'limit': 8}
+    
+    # Automation dry run: fast-forwards the rule set without touching real devices
+    automation_config = {
+        'dry_run_days': 365,
+        'max_dry_run_days': 3650,
+        'max_api_dry_run_days': 366,
+        'conflict_window': 15,  # minutes within which different outcomes on one device conflict
+    }
+    dry_run_state = {'running': False}
+    
+    # Device discovery: probe a network segment and bulk-register what answers
+    discovery_config = {
+        'port': 9900,  # probed on every host of a CIDR segment
+        'concurrency': 100,
+        'timeout': 0.5,
+        'simulator_devices': 500,
+        'simulator_port': 20000,  # the simulator listens on 127.0.0.1 from this port up
+    }
+    discovery_state = shared_state.setdefault('discovery_state', {'running': False})
     
-    # Energy data for charts (simulated hourly consumption)
-    energy_data = [random.randint(50, 200) for _ in range(24)]
+    # Load simulation: synthetic traffic or replayed exports against a scratch property
+    simulation_config = {
+        'property': 'simulation',
+        'seed': 42,
+        'max_latency_samples': 100000,
+    }
+    simulation_state = shared_state.setdefault('simulation_state', {'running': False, 'stop': False, 'mode': None,
+                                                                    'events': 0, 'latencies': [], 'result': None})
     
     def get_theme_colors():
         if page.theme_mode == ft.ThemeMode.DARK:
@@ -64,65 +775,1161 @@ def main(page: ft.Page):
     def toggle_theme(e):
         page.theme_mode = ft.ThemeMode.DARK if page.theme_mode == ft.ThemeMode.LIGHT else ft.ThemeMode.LIGHT
         page.bgcolor = get_theme_colors()['bg']
+        # Every cached control carries the old theme's colors
+        view_cache.clear()
+        card_cache.clear()
         refresh_current_page()
     
-    def log_action(device_id, action):
+    def log_action(device_id, action, user=None, shard=None, status='requested'):
+        shard = shard or properties[active_property['id']]
+        device = shard['devices'][device_id]
         now = datetime.now()
-        action_log.insert(0, {
-            'time': now,
-            'device': device_id,
-            'action': action,
-            'user': current_user['username'],
-            'room': devices[device_id]['room']
-        })
+        with shard['lock']:
+            log_store_append(shard['action_log'], now, device_id, device['room'],
+                             user or current_user['username'], action, LOG_STATUSES.index(status))
+            update_heatmaps(shard, device_id, device, now, count_action=status == 'requested')
         
         # Add notification
-        add_notification(f"{devices[device_id]['name']}: {action}", "info")
+        prefix = "" if shard['id'] == active_property['id'] else f"{shard['name']} · "
+        if status == 'requested':
+            add_notification(f"{prefix}{device['name']}: {action}", "info")
+        elif status == 'failed':
+            add_notification(f"{prefix}{device['name']}: {action} failed, change reverted", "warning", shard)
+    
+    def get_heatmaps(shard, device_id, room):
+        heatmaps = shard['heatmaps']
+        if device_id not in heatmaps['devices']:
+            heatmaps['devices'][device_id] = new_heatmap()
+        if room not in heatmaps['rooms']:
+            heatmaps['rooms'][room] = new_heatmap()
+        return heatmaps['devices'][device_id], heatmaps['rooms'][room]
+    
+    def add_on_time(targets, start, end):
+        # Split an active interval over the hour buckets it covers
+        while start < end:
+            hour_end = min(end, start.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1))
+            bucket = start.weekday() * 24 + start.hour
+            for heatmap in targets:
+                heatmap['on_seconds'][bucket] += (hour_end - start).total_seconds()
+            start = hour_end
+    
+    def update_heatmaps(shard, device_id, device, now, count_action=True):
+        # Called for every logged action, so the counters never need a log rescan
+        targets = get_heatmaps(shard, device_id, device['room'])
+        if count_action:
+            bucket = now.weekday() * 24 + now.hour
+            for heatmap in targets:
+                heatmap['actions'][bucket] += 1
+        
+        active_since = shard['active_since']
+        if is_device_active(device):
+            active_since.setdefault(device_id, now.timestamp())
+        elif device_id in active_since:
+            add_on_time(targets, datetime.fromtimestamp(active_since.pop(device_id)), now)
+            shard['profile_rows'].pop(device_id, None)
+    
+    def get_heatmap_view(shard, device_id=None, room=None):
+        # Counters plus the still-open active intervals, for display
+        with shard['lock']:
+            if device_id:
+                sources = [shard['heatmaps']['devices'].get(device_id)]
+                open_devices = [device_id]
+            elif room:
+                sources = [shard['heatmaps']['rooms'].get(room)]
+                open_devices = [other_id for other_id, device in shard['devices'].items() if device['room'] == room]
+            else:
+                sources = list(shard['heatmaps']['rooms'].values())
+                open_devices = list(shard['active_since'])
+            combined = new_heatmap()
+            for heatmap in sources:
+                if heatmap:
+                    for bucket in range(168):
+                        combined['actions'][bucket] += heatmap['actions'][bucket]
+                        combined['on_seconds'][bucket] += heatmap['on_seconds'][bucket]
+            now = datetime.now()
+            for open_id in open_devices:
+                if open_id in shard['active_since']:
+                    add_on_time([combined], datetime.fromtimestamp(shard['active_since'][open_id]), now)
+        return combined
+    
+    def save_state():
+        # Device states are not persisted, so neither are the open active intervals
+        data = {'properties': {}}
+        for property_id, shard in list(properties.items()):
+            if property_id == simulation_config['property']:
+                continue
+            with shard['lock']:
+                data['properties'][property_id] = {
+                    'heatmaps': {
+                        kind: {key: {'actions': list(heatmap['actions']), 'on_seconds': list(heatmap['on_seconds'])}
+                               for key, heatmap in shard['heatmaps'][kind].items()}
+                        for kind in ('devices', 'rooms')
+                    },
+                    'heatmaps_since': shard['heatmaps_since'],
+                    'history': get_saved_history(shard),
+                }
+        temp_path = state_config['path'] + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, state_config['path'])
+    
+    def get_saved_history(shard):
+        # Compacted history as JSON; rebuilt only after a compaction changed it
+        saved = shard['saved_history']
+        if not saved or saved[0] != shard['compactions']:
+            saved = shard['saved_history'] = (shard['compactions'], {
+                'aggregates': [[device_id, hour_start.timestamp(), bucket]
+                               for (device_id, hour_start), bucket in shard['log_aggregates'].items()],
+                'last_compacted': {device_id: serialize_log(log) for device_id, log in shard['last_compacted'].items()},
+            })
+        return saved[1]
+    
+    def load_state():
+        try:
+            with open(state_config['path']) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for property_id, saved in data.get('properties', {}).items():
+            shard = properties.get(property_id)
+            if not shard:
+                continue
+            for kind in ('devices', 'rooms'):
+                for key, heatmap in saved.get('heatmaps', {}).get(kind, {}).items():
+                    shard['heatmaps'][kind][key] = {'actions': array('I', heatmap['actions']),
+                                                    'on_seconds': array('d', heatmap['on_seconds'])}
+            shard['heatmaps_since'] = saved.get('heatmaps_since', shard['heatmaps_since'])
+            history = saved.get('history', {})
+            for device_id, hour_start, bucket in history.get('aggregates', []):
+                hour_start = datetime.fromtimestamp(hour_start)
+                shard['log_aggregates'][(device_id, hour_start)] = bucket
+                shard['aggregate_index'].setdefault(device_id, set()).add(hour_start)
+            for device_id, log in history.get('last_compacted', {}).items():
+                shard['last_compacted'][device_id] = dict(log, time=datetime.strptime(log['time'], '%Y-%m-%d %H:%M:%S'))
     
-    def add_notification(message, type="info"):
+    def state_saver():
+        while True:
+            time.sleep(state_config['save_interval'])
+            try:
+                save_state()
+            except OSError as ex:
+                add_notification(f"Could not save state: {ex}", "warning")
+    
+    def add_notification(message, type="info", shard=None):
+        if shard and type == "warning":
+            shard['alerts'].append(datetime.now())
         notifications.insert(0, {
             'time': datetime.now(),
             'message': message,
             'type': type
         })
-        if len(notifications) > 50:
-            notifications.pop()
+        while len(notifications) > retention['max_notifications']:
+            dropped = notifications.pop()
+            dropped_notifications[dropped['type']] = dropped_notifications.get(dropped['type'], 0) + 1
     
-    def toggle_device(e):
-        device_id = e.control.data
-        devices[device_id]['state'] = not devices[device_id]['state']
-        device = devices[device_id]
+    def get_aggregate_bucket(shard, device_id, room, when):
+        hour_start = when.replace(minute=0, second=0, microsecond=0)
+        key = (device_id, hour_start)
+        if key not in shard['log_aggregates']:
+            shard['log_aggregates'][key] = {'room': room, 'count': 0, 'actions': {}, 'durations': {}}
+            shard['aggregate_index'].setdefault(device_id, set()).add(hour_start)
+        return shard['log_aggregates'][key]
+    
+    def compact_logs(shard):
+        now = datetime.now()
+        raw_cutoff = now - timedelta(days=retention['raw_days'])
+        aggregate_cutoff = now - timedelta(days=retention['aggregate_days'])
+        shard_log = shard['action_log']
         
+        with shard['lock']:
+            # The log is oldest first, so expired entries are a prefix
+            cutoff = raw_cutoff.timestamp()
+            expired_count = 0
+            while expired_count < log_store_len(shard_log) and shard_log['time'][expired_count] < cutoff:
+                expired_count += 1
+            
+            for index in range(expired_count):
+                log = log_store_row(shard_log, index)
+                bucket = get_aggregate_bucket(shard, log['device'], log['room'], log['time'])
+                if log['status'] != 'requested':
+                    # Outcome rows only add to the failure count
+                    if log['status'] == 'failed':
+                        bucket['failed'] = bucket.get('failed', 0) + 1
+                    continue
+                bucket['count'] += 1
+                bucket['actions'][log['action']] = bucket['actions'].get(log['action'], 0) + 1
+                
+                # The previous action's state lasted until this one
+                previous = shard['last_compacted'].get(log['device'])
+                if previous and log['time'] < previous['time']:
+                    continue  # imported history older than what was already compacted has no durations
+                if previous:
+                    prev_bucket = get_aggregate_bucket(shard, log['device'], previous['room'], previous['time'])
+                    seconds = (log['time'] - previous['time']).total_seconds()
+                    prev_bucket['durations'][previous['action']] = prev_bucket['durations'].get(previous['action'], 0) + seconds
+                shard['last_compacted'][log['device']] = log
+            
+            log_store_drop_oldest(shard_log, expired_count)
+            shard['compactions'] += 1
+            
+            aggregates = shard['log_aggregates']
+            for key in [key for key in aggregates if key[1] < aggregate_cutoff]:
+                del aggregates[key]
+                device_hours = shard['aggregate_index'][key[0]]
+                device_hours.discard(key[1])
+                if not device_hours:
+                    del shard['aggregate_index'][key[0]]
+        
+        return expired_count
+    
+    def get_aggregate_summary(device_id=None, room=None):
+        summary = {'count': 0, 'hours': 0, 'actions': {}, 'durations': {}, 'first': None, 'last': None}
+        with log_lock:
+            if device_id:
+                hours = properties[active_property['id']]['aggregate_index'].get(device_id, ())
+                buckets = [((device_id, hour_start), log_aggregates[(device_id, hour_start)]) for hour_start in hours]
+            else:
+                buckets = log_aggregates.items()
+            for (bucket_device, hour_start), bucket in buckets:
+                if room and bucket['room'] != room:
+                    continue
+                summary['count'] += bucket['count']
+                summary['hours'] += 1
+                for action, count in bucket['actions'].items():
+                    summary['actions'][action] = summary['actions'].get(action, 0) + count
+                for action, seconds in bucket['durations'].items():
+                    summary['durations'][action] = summary['durations'].get(action, 0) + seconds
+                if summary['first'] is None or hour_start < summary['first']:
+                    summary['first'] = hour_start
+                if summary['last'] is None or hour_start > summary['last']:
+                    summary['last'] = hour_start
+        return summary
+    
+    def is_device_active(device):
+        if device['type'] in ['light', 'door', 'camera']:
+            return device['state']
+        return device['value'] > 0
+    
+    def get_device_power(device):
+        if device['type'] in ['light', 'door', 'camera']:
+            return device['power'] if device['state'] else 0
+        return device['power'] * (device['value'] / (30 if device['type'] == 'thermostat' else 3))
+    
+    def compute_property_summary(shard):
+        now = datetime.now()
+        active = power = security = 0
+        with shard['lock']:
+            for device in shard['devices'].values():
+                if is_device_active(device):
+                    active += 1
+                    power += get_device_power(device)
+                elif device['type'] in ['door', 'camera']:
+                    # Unlocked doors and disabled cameras need attention
+                    security += 1
+            shard['alerts'] = [when for when in shard['alerts'] if now - when < shard_config['alert_window']]
+            shard['summary'] = {
+                'devices': len(shard['devices']),
+                'active': active,
+                'power': power,
+                'alerts': security + len(shard['alerts']),
+                'updated': now,
+            }
+        return shard['summary']
+    
+    def record_energy_sample(shard, now):
+        # Hourly energy store: average of the power samples taken in each hour
+        samples = shard['energy_samples']
+        if samples['hour'] != now.hour:
+            samples.update({'hour': now.hour, 'total': 0.0, 'count': 0})
+        samples['total'] += shard['summary']['power']
+        samples['count'] += 1
+        shard['energy_data'][now.hour] = round(samples['total'] / samples['count'])
+    
+    def detect_anomalies(shard, now):
+        # One pass over parallel arrays covering every device in the property
+        started = time.perf_counter()
+        state = shard['anomaly']
+        with shard['lock']:
+            if len(state['devices']) < len(shard['devices']):
+                for device_id in itertools.islice(shard['devices'], len(state['devices']), None):
+                    state['devices'].append((device_id, shard['devices'][device_id]))
+                added = len(state['devices']) - len(state['flags'])
+                for name in ('power_mean', 'power_var', 'on_since', 'duration_mean', 'duration_var'):
+                    state[name].extend([0.0] * added)
+                for name in ('power_samples', 'duration_samples', 'flags'):
+                    state[name].extend([0] * added)
+            
+            alpha, duration_alpha = anomaly_config['power_alpha'], anomaly_config['duration_alpha']
+            threshold, min_delta = anomaly_config['threshold'], anomaly_config['min_power_delta']
+            min_ratio = anomaly_config['min_power_ratio'] - 1
+            max_on_hours, min_on = anomaly_config['max_on_hours'], anomaly_config['min_on_hours'] * 3600
+            timestamp = now.timestamp()
+            power_mean, power_var, power_samples = state['power_mean'], state['power_var'], state['power_samples']
+            duration_mean, duration_var, duration_samples = state['duration_mean'], state['duration_var'], state['duration_samples']
+            on_since, flags = state['on_since'], state['flags']
+            flagged = []
+            for index, (device_id, device) in enumerate(state['devices']):
+                flag = 0
+                if is_device_active(device):
+                    power = get_device_power(device)
+                    mean = power_mean[index]
+                    if not power_samples[index]:
+                        power_mean[index] = power
+                    else:
+                        if power_samples[index] >= anomaly_config['power_warmup'] and \
+                                power - mean > max(min_delta, min_ratio * mean, threshold * power_var[index] ** 0.5):
+                            flag = 1
+                        # Incremental EWMA mean and variance
+                        diff = power - mean
+                        power_mean[index] = mean + alpha * diff
+                        power_var[index] = (1 - alpha) * (power_var[index] + alpha * diff * diff)
+                    power_samples[index] += 1
+                    
+                    if device['type'] in max_on_hours:
+                        if not on_since[index]:
+                            on_since[index] = timestamp
+                        if duration_samples[index] >= anomaly_config['duration_warmup']:
+                            limit = max(min_on, duration_mean[index] + threshold * duration_var[index] ** 0.5)
+                        else:
+                            limit = max_on_hours[device['type']] * 3600
+                        if timestamp - on_since[index] > limit:
+                            flag |= 2
+                elif on_since[index]:
+                    duration = timestamp - on_since[index]
+                    on_since[index] = 0.0
+                    if duration_samples[index]:
+                        diff = duration - duration_mean[index]
+                        duration_mean[index] += duration_alpha * diff
+                        duration_var[index] = (1 - duration_alpha) * (duration_var[index] + duration_alpha * diff * diff)
+                    else:
+                        duration_mean[index] = duration
+                    duration_samples[index] += 1
+                
+                if flag & ~flags[index]:
+                    flagged.append((index, device_id, device, flag & ~flags[index]))
+                flags[index] = flag
+        
+        for index, device_id, device, new_flags in flagged:
+            if new_flags & 1:
+                add_notification(f"{device['name']} is drawing {get_device_power(device):.0f}W, usually "
+                                 f"{power_mean[index]:.0f}W", "warning", shard=shard)
+            if new_flags & 2:
+                hours_on = (timestamp - on_since[index]) / 3600
+                add_notification(f"{device['name']} has been on for {hours_on:.1f}h", "warning", shard=shard)
+        if flagged:
+            request_render(shard)
+        state['elapsed_ms'] = (time.perf_counter() - started) * 1000
+        return flagged
+    
+    def run_due_rules(shard, now):
+        minute = now.strftime('%H:%M')
+        for rule in list(shard['automation_rules']):
+            if not rule['enabled'] or rule['time'] != minute or rule['device'] not in shard['devices']:
+                continue
+            if shard['fired_rules'].get(rule['id']) == now.date():
+                continue
+            shard['fired_rules'][rule['id']] = now.date()
+            fire_rule(shard, rule)
+    
+    def fire_rule(shard, rule):
+        update = parse_action(rule['action'])
+        if update:
+            set_device_state(rule['device'], user='automation', shard=shard, **update)
+    
+    def property_worker(shard):
+        last_compaction = 0
+        last_error = None
+        while not shard['stopped']:
+            now = datetime.now()
+            try:
+                # The summary comes first so it stays fresh even if a later step keeps failing
+                compute_property_summary(shard)
+                record_energy_sample(shard, now)
+                run_due_rules(shard, now)
+                detect_anomalies(shard, now)
+                if time.time() - last_compaction >= retention['compact_interval']:
+                    compact_logs(shard)
+                    last_compaction = time.time()
+                last_error = None
+            except Exception as ex:
+                # One bad tick must not stop the shard; the next tick tries again, and a
+                # failure that repeats every tick is reported once
+                if repr(ex) != last_error:
+                    last_error = repr(ex)
+                    add_notification(f"{shard['name']}: background update failed: {last_error}", "warning", shard=shard)
+            time.sleep(shard_config['tick_interval'])
+    
+    def start_property(shard):
+        # Only listed once its summary exists, so a bad shard never shows up half-started
+        compute_property_summary(shard)
+        properties[shard['id']] = shard
+        # Devices that start out active accumulate heatmap time from now on
+        started = datetime.now().timestamp()
+        for device_id, device in shard['devices'].items():
+            if is_device_active(device):
+                shard['active_since'].setdefault(device_id, started)
+        threading.Thread(target=property_worker, args=(shard,), daemon=True).start()
+    
+    def switch_property(property_id):
+        nonlocal devices, action_log, automation_rules, energy_data, log_aggregates, log_lock
+        selected = properties[property_id]
+        active_property['id'] = property_id
+        devices = selected['devices']
+        action_log = selected['action_log']
+        automation_rules = selected['automation_rules']
+        energy_data = selected['energy_data']
+        log_aggregates = selected['log_aggregates']
+        log_lock = selected['lock']
+        show_overview()
+    
+    def get_device_action(device):
         if device['type'] == 'light':
-            action = 'Turn ON' if device['state'] else 'Turn OFF'
+            return 'Turn ON' if device['state'] else 'Turn OFF'
         elif device['type'] == 'door':
-            action = 'Lock' if device['state'] else 'Unlock'
+            return 'Lock' if device['state'] else 'Unlock'
         elif device['type'] == 'camera':
-            action = 'Enable' if device['state'] else 'Disable'
+            return 'Enable' if device['state'] else 'Disable'
+        elif device['type'] == 'thermostat':
+            return f"Set to {device['value']:.1f}°C"
+        else:
+            return f"Set speed to {int(device['value'])}"
+    
+    def parse_action(action):
+        # Inverse of get_device_action: the update an action label describes
+        if action in ('Turn ON', 'Lock', 'Enable'):
+            return {'state': True}
+        if action in ('Turn OFF', 'Unlock', 'Disable'):
+            return {'state': False}
+        if action.startswith('Set to '):
+            return {'value': float(action[len('Set to '):].rstrip('°C'))}
+        if action.startswith('Set speed to '):
+            return {'value': float(action[len('Set speed to '):])}
+        return None
+    
+    def get_device_snapshot(device):
+        return {'state': device['state']} if 'state' in device else {'value': device['value']}
+    
+    def remember_confirmed(shard, device_id):
+        # The state to roll back to if the device rejects a command
+        shard['confirmed'].setdefault(device_id, get_device_snapshot(shard['devices'][device_id]))
+    
+    def schedule_task(delay, callback, *args):
+        with command_state['condition']:
+            heapq.heappush(command_state['tasks'], (time.monotonic() + delay, next(command_state['sequence']), callback, args))
+            command_state['condition'].notify()
+    
+    def command_worker():
+        # Runs acknowledgements and retries for every property on one thread
+        condition = command_state['condition']
+        while True:
+            with condition:
+                while not command_state['tasks'] or command_state['tasks'][0][0] > time.monotonic():
+                    condition.wait(command_state['tasks'][0][0] - time.monotonic() if command_state['tasks'] else None)
+                _, _, callback, args = heapq.heappop(command_state['tasks'])
+            callback(*args)
+    
+    def simulated_send(shard, command, on_result):
+        # Stand-in for real hardware: answers after a random delay, sometimes with a failure
+        delay = random.uniform(*command_config['latency'])
+        schedule_task(delay, on_result, shard, command, random.random() >= command_config['failure_rate'])
+    
+    def send_command(shard, command):
+        command['attempts'] += 1
+        device_transport['send'](shard, command, on_command_result)
+    
+    def on_command_result(shard, command, ok):
+        device_id = command['device']
+        with shard['lock']:
+            if shard['pending'].get(device_id) is not command:
+                return  # superseded by a newer command for this device
+            if not ok and command['attempts'] < command_config['max_attempts']:
+                delay = command_config['retry_backoff'] * 2 ** (command['attempts'] - 1)
+                schedule_task(delay, send_command, shard, command)
+                return
+            del shard['pending'][device_id]
+            device = shard['devices'][device_id]
+            if ok:
+                shard['confirmed'][device_id] = get_device_snapshot(device)
+            else:
+                device.update(shard['confirmed'].get(device_id, {}))
+                shard['revision'] += 1
+        
+        log_action(device_id, command['action'], command['user'], shard, 'confirmed' if ok else 'failed')
+        publish_state_change(shard, device_id)
+    
+    def set_device_state(device_id, state=None, value=None, user=None, shard=None):
+        # Shared state engine used by the UI handlers, automation and the control API.
+        # The change is applied optimistically and confirmed or reverted by the device later.
+        shard = shard or properties[active_property['id']]
+        device = shard['devices'][device_id]
+        with shard['lock']:
+            remember_confirmed(shard, device_id)
+            if 'state' in device and state is not None:
+                device['state'] = bool(state)
+            elif 'value' in device and value is not None:
+                min_val, max_val = (15, 30) if device['type'] == 'thermostat' else (0, 3)
+                device['value'] = min(max(float(value), min_val), max_val)
+            else:
+                raise ValueError(f"Invalid update for {device_id}")
+            action = get_device_action(device)
+            command = {'id': next(command_state['sequence']), 'device': device_id, 'action': action,
+                       'user': user or current_user['username'], 'attempts': 0}
+            shard['pending'][device_id] = command
+            shard['revision'] += 1
         
-        log_action(device_id, action)
+        log_action(device_id, action, user, shard)
+        publish_state_change(shard, device_id)
+        send_command(shard, command)
+        return action
+    
+    def authorize(permission):
+        # Checked against the cached session, so it is cheap enough for every click
+        session = verify_session(current_user['token'])
+        if has_permission(session, permission):
+            return True
+        if not session:
+            show_login()
+        else:
+            add_notification(f"The {session['role']} role cannot do that", "warning")
+            page.update()
+        return False
+    
+    def toggle_device(e):
+        if not authorize('control'):
+            return
+        device_id = e.control.data
+        set_device_state(device_id, state=not devices[device_id]['state'])
         refresh_current_page()
     
     def on_slider_change(e):
+        if not authorize('control'):
+            return
         device_id = e.control.data
         value = float(e.control.value)
+        remember_confirmed(properties[active_property['id']], device_id)
         devices[device_id]['value'] = value
         refresh_current_page()
     
     def on_slider_end(e):
+        if not authorize('control'):
+            return
         device_id = e.control.data
-        value = devices[device_id]['value']
-        device = devices[device_id]
+        set_device_state(device_id, value=devices[device_id]['value'])
+    
+    def parse_discovery_targets(spec):
+        # "192.168.1.0/24" probes discovery_config['port'] on each host,
+        # "127.0.0.1:20000-20499" probes a port range on one host
+        host, _, ports = spec.strip().partition(':')
+        if ports:
+            first, _, last = ports.partition('-')
+            return [(host, port) for port in range(int(first), int(last or first) + 1)]
+        return [(str(address), discovery_config['port']) for address in ipaddress.ip_network(host, strict=False).hosts()]
+    
+    async def probe_device(host, port, semaphore):
+        async with semaphore:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), discovery_config['timeout'])
+            except (OSError, asyncio.TimeoutError):
+                return None
+            try:
+                writer.write(b"IDENTIFY\n")
+                line = await asyncio.wait_for(reader.readline(), discovery_config['timeout'])
+                info = json.loads(line)
+            except (OSError, ValueError, asyncio.TimeoutError):
+                return None
+            finally:
+                writer.close()
+        if not isinstance(info, dict) or info.get('type') not in ['light', 'door', 'camera', 'fan', 'thermostat'] or not info.get('id'):
+            return None
+        info['address'] = f"{host}:{port}"
+        return info
+    
+    async def start_device_simulator(count, base_port):
+        # Fake devices on localhost that answer IDENTIFY like real hardware would
+        device_types = [('light', 60), ('door', 5), ('camera', 10), ('fan', 75), ('thermostat', 150)]
+        
+        def identity_handler(index):
+            device_type, power = device_types[index % len(device_types)]
+            identity = json.dumps({'id': f"{device_type}-{base_port + index}", 'name': f"{device_type.title()} {index + 1}",
+                                   'type': device_type, 'room': f"Floor {index // 50 + 1}", 'power': power}).encode()
+            
+            async def handle(reader, writer):
+                if (await reader.readline()).strip() == b"IDENTIFY":
+                    writer.write(identity + b"\n")
+                    await writer.drain()
+                writer.close()
+            return handle
+        
+        return [await asyncio.start_server(identity_handler(i), '127.0.0.1', base_port + i) for i in range(count)]
+    
+    async def discover_devices(targets, simulate):
+        servers = await start_device_simulator(discovery_config['simulator_devices'], discovery_config['simulator_port']) if simulate else []
+        try:
+            semaphore = asyncio.Semaphore(discovery_config['concurrency'])
+            results = await asyncio.gather(*(probe_device(host, port, semaphore) for host, port in targets))
+        finally:
+            for server in servers:
+                server.close()
+        return [info for info in results if info]
+    
+    def register_devices(shard, discovered):
+        # One batched registry update for everything found; identities that fail
+        # validation are skipped and counted
+        batch, invalid = {}, 0
+        for info in discovered:
+            if not isinstance(info['id'], str):
+                invalid += 1
+                continue
+            if info['id'] in shard['devices'] or info['id'] in batch:
+                continue
+            device = {'name': str(info.get('name', info['id'])), 'type': info['type'],
+                      'room': str(info.get('room', 'Unassigned')), 'power': info.get('power', 0), 'address': info['address']}
+            if info['type'] in ['light', 'door', 'camera']:
+                device['state'] = info.get('state', False)
+            else:
+                device['value'] = info.get('value', 22.0 if info['type'] == 'thermostat' else 0)
+            if validate_device_spec(info['id'], device):
+                invalid += 1
+                continue
+            if 'value' in device:
+                device['value'] = float(device['value'])
+            batch[info['id']] = device
+        with shard['lock']:
+            shard['devices'].update(batch)
+            search_index_add(shard['search'], batch)
+            shard['revision'] += 1
+        return len(batch), invalid
+    
+    def run_discovery(spec, simulate, shard=None):
+        shard = shard or properties[active_property['id']]
+        if discovery_state['running']:
+            return
+        discovery_state['running'] = True
+        try:
+            started = time.perf_counter()
+            targets = parse_discovery_targets(spec)
+            discovered = asyncio.run(discover_devices(targets, simulate))
+            added, invalid = register_devices(shard, discovered)
+            add_notification(f"Discovery probed {len(targets)} addresses in {time.perf_counter() - started:.1f}s: "
+                             f"{len(discovered)} found, {added} new devices added"
+                             + (f", {invalid} invalid skipped" if invalid else ""), "success")
+        except (OSError, ValueError) as ex:
+            add_notification(f"Discovery failed: {ex}", "warning")
+        finally:
+            discovery_state['running'] = False
+        if shard['id'] == active_property['id']:
+            refresh_current_page()
+    
+    def get_device_level(device, update=None):
+        # Fraction of rated power drawn in a state, the same scale get_device_power uses
+        device = dict(device, **update) if update else device
+        return get_device_power(device) / device['power'] if device['power'] else 0
+    
+    def get_profile_row(shard, device_id, device, start_hour, slots, weight):
+        # Weighted watts for each forecast slot from the device's heatmap: its on-time per hour
+        # of day summed over the weekdays, averaged over the days the heatmaps have counted
+        heatmap = shard['heatmaps']['devices'].get(device_id)
+        if not heatmap:
+            return None
+        days = max(1, int((time.time() - shard['heatmaps_since']) // 86400))
+        key = (start_hour, slots, weight, device['power'], days)
+        cached = shard['profile_rows'].get(device_id)
+        if not cached or cached[0] != key:
+            on_seconds = [sum(heatmap['on_seconds'][hour::24]) for hour in range(24)]
+            scale = weight * device['power'] / (3600 * days)
+            row = [min(on_seconds[(start_hour + slot) % 24] * scale, weight * device['power'])
+                   for slot in range(slots)] if any(on_seconds) else None
+            cached = shard['profile_rows'][device_id] = (key, row)
+        return cached[1]
+    
+    def compute_forecast(shard):
+        now = datetime.now()
+        cache_key = (shard['revision'], now.replace(minute=0, second=0, microsecond=0))
+        if shard['forecast'] and shard['forecast']['key'] == cache_key:
+            return shard['forecast']
+        
+        started = time.perf_counter()
+        slots = forecast_config['hours']
+        weight = forecast_config['history_weight']
+        hour_of_slot = [(now.hour + slot) % 24 for slot in range(slots)]
+        
+        with shard['lock']:
+            device_items = list(shard['devices'].items())
+            # Rule firings within the horizon, by device: (slot, level update)
+            rule_events = {}
+            for rule in shard['automation_rules']:
+                if not rule['enabled'] or rule['device'] not in shard['devices']:
+                    continue
+                update = parse_action(rule['action'])
+                if not update:
+                    continue
+                hour, minute = (int(part) for part in rule['time'].split(':'))
+                slot = (hour - now.hour) % 24
+                if slot == 0 and minute <= now.minute:
+                    continue  # already fired this hour, next run is beyond the horizon
+                if slot < slots:
+                    rule_events.setdefault(rule['device'], []).append((slot, update))
+            levels = [get_device_level(device) for _, device in device_items]
+            profile_rows = [get_profile_row(shard, device_id, device, now.hour, slots, weight) for device_id, device in device_items]
+        
+        # Devices x slots power matrix: each row starts at the current power and each
+        # scheduled rule overwrites the rest of the row with one slice assignment; the
+        # usage history is blended in by adding its precomputed row
+        matrix = []
+        for (device_id, device), level, profile_row in zip(device_items, levels, profile_rows):
+            scale = device['power'] * (1 - weight if profile_row else 1)
+            row = [level * scale] * slots
+            for slot, update in sorted(rule_events.get(device_id, ()), key=lambda event: event[0]):
+                row[slot:] = [get_device_level(device, update) * scale] * (slots - slot)
+            matrix.append(list(map(operator.add, row, profile_row)) if profile_row else row)
+        
+        totals = [sum(column) for column in zip(*matrix)] if matrix else [0.0] * slots
+        shard['forecast'] = {
+            'key': cache_key,
+            'start': now.replace(minute=0, second=0, microsecond=0),
+            'hours': [f"{hour:02d}:00" for hour in hour_of_slot],
+            'devices': {device_id: row for (device_id, _), row in zip(device_items, matrix)},
+            'total': totals,
+            'energy_kwh': sum(totals) / 1000,
+            'elapsed_ms': (time.perf_counter() - started) * 1000,
+        }
+        return shard['forecast']
+    
+    def simulate_automation(shard, days=None):
+        # Event-driven: jumps from one rule firing to the next instead of stepping minutes
+        days = max(1, min(days or automation_config['dry_run_days'], automation_config['max_dry_run_days']))
+        started = time.perf_counter()
+        now = datetime.now()
+        horizon = days * 1440
+        minute_now = now.hour * 60 + now.minute
+        
+        with shard['lock']:
+            sim_devices = {device_id: dict(device) for device_id, device in shard['devices'].items()}
+            rules = [(rule, parse_action(rule['action'])) for rule in shard['automation_rules']
+                     if rule['enabled'] and rule['device'] in sim_devices]
+        rules = [(rule, update) for rule, update in rules if update]
+        
+        # (minutes from now, rule order, rule index); rules at the same minute fire in list order
+        events = []
+        for index, (rule, _) in enumerate(rules):
+            hour, minute = (int(part) for part in rule['time'].split(':'))
+            first = (hour * 60 + minute - minute_now) % 1440 or 1440
+            if first < horizon:
+                events.append((first, index))
+        heapq.heapify(events)
+        
+        stats = {device_id: {'on_minutes': 0.0, 'energy_wh': 0.0, 'conflicts': 0, 'redundant': 0} for device_id in sim_devices}
+        last_change = dict.fromkeys(sim_devices, 0)
+        rule_stats = {rule['id']: {'runs': 0, 'redundant': 0} for rule, _ in rules}
+        conflicts = {}
+        # Device id -> (minute, rule index) of the latest rule that fired on it
+        last_fired = {}
+        window = automation_config['conflict_window']
+        processed = 0
+        
+        def advance(device_id, until):
+            device = sim_devices[device_id]
+            elapsed = until - last_change[device_id]
+            if is_device_active(device):
+                stats[device_id]['on_minutes'] += elapsed
+            stats[device_id]['energy_wh'] += get_device_power(device) * elapsed / 60
+            last_change[device_id] = until
+        
+        while events:
+            when = events[0][0]
+            firing = {}
+            while events and events[0][0] == when:
+                _, index = heapq.heappop(events)
+                firing.setdefault(rules[index][0]['device'], []).append(index)
+                if when + 1440 < horizon:
+                    heapq.heappush(events, (when + 1440, index))
+            processed += sum(len(indexes) for indexes in firing.values())
+            
+            for device_id, indexes in firing.items():
+                device = sim_devices[device_id]
+                advance(device_id, when)
+                for index in indexes:
+                    rule, update = rules[index]
+                    # Another rule setting a different outcome shortly before (or in the same
+                    # minute, where list order decides) means the two undo each other
+                    previous = last_fired.get(device_id)
+                    if previous and previous[1] != index and when - previous[0] <= window and rules[previous[1]][1] != update:
+                        other = rules[previous[1]][0]
+                        key = (device_id, other['id'], rule['id'])
+                        if key not in conflicts:
+                            conflicts[key] = {'device': device_id, 'rules': [other['name'], rule['name']], 'count': 0,
+                                              'time': other['time'] if other['time'] == rule['time'] else f"{other['time']}-{rule['time']}"}
+                        conflicts[key]['count'] += 1
+                        stats[device_id]['conflicts'] += 1
+                    last_fired[device_id] = (when, index)
+                    rule_stats[rule['id']]['runs'] += 1
+                    if all(device.get(field) == value for field, value in update.items()):
+                        rule_stats[rule['id']]['redundant'] += 1
+                        stats[device_id]['redundant'] += 1
+                    else:
+                        device.update(update)
+        
+        for device_id in sim_devices:
+            advance(device_id, horizon)
+        
+        shard['dry_run'] = {
+            'start': now,
+            'days': days,
+            'events': processed,
+            'devices': {device_id: {'on_hours': stat['on_minutes'] / 60, 'energy_kwh': stat['energy_wh'] / 1000,
+                                    'conflicts': stat['conflicts'], 'redundant': stat['redundant']}
+                        for device_id, stat in stats.items()},
+            'rules': rule_stats,
+            'conflicts': sorted(conflicts.values(), key=lambda conflict: conflict['count'], reverse=True),
+            'energy_kwh': sum(stat['energy_wh'] for stat in stats.values()) / 1000,
+            'elapsed_ms': (time.perf_counter() - started) * 1000,
+        }
+        return shard['dry_run']
+    
+    def run_dry_run_in_background(shard, days):
+        # Years of rules take a while, so the UI handler only starts this thread
+        try:
+            result = simulate_automation(shard, days)
+        finally:
+            dry_run_state['running'] = False
+        add_notification(f"Dry run of {len(shard['automation_rules'])} rules over {result['days']} days: "
+                         f"{len(result['conflicts'])} conflicts", "info")
+        if current_page_state['page'] == 'automation':
+            refresh_current_page()
+    
+    def device_event(device_id, value=None):
+        # Stand-in for the Flet event the UI handlers receive
+        return types.SimpleNamespace(control=types.SimpleNamespace(data=device_id, value=value))
+    
+    def start_simulation_property(sim_devices):
+        previous = properties.get(simulation_config['property'])
+        if previous:
+            previous['stopped'] = True
+        start_property(new_property(simulation_config['property'], "Load Simulation", sim_devices))
+        switch_property(simulation_config['property'])
+    
+    def create_synthetic_devices(count, rng):
+        device_types = [('light', 60), ('door', 5), ('camera', 10), ('fan', 75), ('thermostat', 150)]
+        sim_devices = {}
+        for i in range(count):
+            device_type, power = device_types[i % len(device_types)]
+            device = {'name': f"Sim {device_type.title()} {i}", 'type': device_type,
+                      'room': f"Zone {i % 20 + 1}", 'power': power}
+            if device_type in ['light', 'door', 'camera']:
+                device['state'] = rng.random() < 0.5
+            else:
+                device['value'] = 22.0 if device_type == 'thermostat' else 0
+            sim_devices[f"sim{i}"] = device
+        return sim_devices
+    
+    def guess_device(device_id, log):
+        # Recreate a device seen in an exported log from its actions
+        update = parse_action(log['action']) or {}
+        if 'value' in update:
+            device_type = 'thermostat' if log['action'].startswith('Set to ') else 'fan'
+        else:
+            device_type = {'Lock': 'door', 'Unlock': 'door', 'Enable': 'camera', 'Disable': 'camera'}.get(log['action'], 'light')
+        device = {'name': device_id, 'type': device_type, 'room': log['room'],
+                  'power': {'light': 60, 'door': 5, 'camera': 10, 'fan': 75, 'thermostat': 150}[device_type]}
+        if device_type in ['light', 'door', 'camera']:
+            device['state'] = not update.get('state', True)
+        else:
+            device['value'] = 22.0 if device_type == 'thermostat' else 0
+        return device
+    
+    def dispatch_simulated_event(kind, device_id, value=None):
+        # Route through the same handlers as a click, a slider drag or a rule firing,
+        # timing until the resulting page update has been sent
+        started = time.perf_counter()
+        if kind == 'toggle':
+            toggle_device(device_event(device_id))
+        elif kind == 'slider':
+            on_slider_change(device_event(device_id, value))
+            on_slider_end(device_event(device_id, value))
+        else:
+            fire_rule(properties[active_property['id']], {'device': device_id, 'action': value})
+            refresh_current_page()
+        
+        latencies = simulation_state['latencies']
+        if len(latencies) < simulation_config['max_latency_samples']:
+            latencies.append(time.perf_counter() - started)
+        simulation_state['events'] += 1
+    
+    def event_for_update(device, update):
+        if 'state' in update:
+            return ('toggle', None) if device['state'] != update['state'] else (None, None)
+        return 'slider', update['value']
+    
+    def run_simulation_loop(events, started):
+        # events yields (due offset in seconds, kind, device id, value)
+        for due, kind, device_id, value in events:
+            if simulation_state['stop']:
+                break
+            delay = due - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            if active_property['id'] != simulation_config['property']:
+                # The handlers act on the active property, so opening another one ends the run
+                add_notification("Simulation stopped because another property was opened", "warning")
+                break
+            dispatch_simulated_event(kind, device_id, value)
+    
+    def finish_simulation(started):
+        elapsed = time.perf_counter() - started
+        latencies = sorted(simulation_state['latencies'])
+        
+        def percentile(fraction):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000 if latencies else 0
+        
+        simulation_state['result'] = {
+            'mode': simulation_state['mode'],
+            'events': simulation_state['events'],
+            'devices': len(properties[simulation_config['property']]['devices']),
+            'rate': simulation_state['events'] / elapsed if elapsed else 0,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': latencies[-1] * 1000 if latencies else 0,
+        }
+        simulation_state['running'] = False
+        result = simulation_state['result']
+        add_notification(f"Simulation finished: {result['events']} events at {result['rate']:.0f}/s, "
+                         f"p95 latency {result['p95']:.1f}ms", "success")
+        refresh_current_page()
+    
+    def begin_simulation(mode):
+        if simulation_state['running']:
+            return False
+        simulation_state.update({'running': True, 'stop': False, 'mode': mode, 'events': 0, 'latencies': [], 'result': None})
+        return True
+    
+    def run_load_generator(device_count, events_per_second, duration):
+        rng = random.Random(simulation_config['seed'])
+        start_simulation_property(create_synthetic_devices(device_count, rng))
+        sim_devices = properties[simulation_config['property']]['devices']
+        device_ids = list(sim_devices)
         
-        if device['type'] == 'thermostat':
-            action = f"Set to {value:.1f}°C"
+        def events():
+            for i in range(int(events_per_second * duration)):
+                device_id = rng.choice(device_ids)
+                device = sim_devices[device_id]
+                due = i / events_per_second
+                if device['type'] in ['light', 'door', 'camera']:
+                    if rng.random() < 0.8:
+                        yield due, 'toggle', device_id, None
+                    else:
+                        yield due, 'rule', device_id, get_device_action(dict(device, state=not device['state']))
+                elif device['type'] == 'thermostat':
+                    yield due, 'slider', device_id, float(rng.randint(15, 30))
+                else:
+                    yield due, 'slider', device_id, float(rng.randint(0, 3))
+        
+        started = time.perf_counter()
+        run_simulation_loop(events(), started)
+        finish_simulation(started)
+    
+    def show_import_progress(status, progress):
+        import_state.update({'status': status, 'progress': progress})
+        controls = import_state['controls']
+        if controls:
+            controls['bar'].value = progress
+            controls['label'].value = status
+            page.update()
+    
+    def import_action_log(filename, shard=None):
+        # Streams the file, so memory does not grow with its size; duplicates of rows
+        # already in the log (or earlier in the file) are skipped
+        shard = shard or properties[active_property['id']]
+        store = shard['action_log']
+        raw_cutoff = (datetime.now() - timedelta(days=retention['raw_days'])).timestamp()
+        aggregate_cutoff = (datetime.now() - timedelta(days=retention['aggregate_days'])).timestamp()
+        counts = {'imported': 0, 'duplicates': 0, 'expired': 0, 'invalid': 0}
+        
+        def row_key(when, device_code, action_code, value, user_code, status):
+            # A command's requested and confirmed rows usually share the second, so status is part of the key
+            return int(when), device_code, action_code, value, user_code, status
+        
+        with shard['lock']:
+            seen = {row_key(*row) for row in zip(store['time'], store['device'], store['action'], store['value'],
+                                                 store['user'], store['status'])}
+            # Compacted rows have no identity left, so hours already compacted are not merged again
+            compacted_hours = set(shard['log_aggregates'])
+        
+        def insert(batch):
+            rows = []
+            with shard['lock']:
+                for when, log in batch:
+                    code, value = encode_action(store, log['action'])
+                    device_code, user_code = intern_string(store, log['device']), intern_string(store, log['user'])
+                    status = LOG_STATUSES.index(log.get('status', 'requested'))
+                    key = row_key(when, device_code, code, value, user_code, status)
+                    if key in seen:
+                        counts['duplicates'] += 1
+                        continue
+                    seen.add(key)
+                    rows.append((when, device_code, intern_string(store, log.get('room', "")), user_code, code, value, status))
+                    if status == 0 and log['device'] in shard['devices']:
+                        local = datetime.fromtimestamp(when)
+                        for heatmap in get_heatmaps(shard, log['device'], log.get('room', "")):
+                            heatmap['actions'][local.weekday() * 24 + local.hour] += 1
+                    counts['imported'] += 1
+                # Requested rows sort before their outcome within the same second
+                rows.sort(key=lambda row: (row[0], row[6]))
+                log_store_merge(store, rows)
+                shard['revision'] += 1
+            # Old history goes straight into the hourly aggregates and out of the raw log
+            compact_logs(shard)
+            # Keys of compacted rows outside the hours this batch covers are replaced by their
+            # hour, so later rows of the file in those hours still count as duplicates
+            if len(seen) > 2 * log_store_len(store) + import_config['batch_size']:
+                low = int(min(when for when, _ in batch)) - 3600
+                high = int(max(when for when, _ in batch)) + 3600
+                with shard['lock']:
+                    cutoff = int(store['time'][0]) if log_store_len(store) else float('inf')
+                    for key in [key for key in seen if key[0] < cutoff and not low <= key[0] <= high]:
+                        seen.discard(key)
+                        hour = datetime.fromtimestamp(key[0]).replace(minute=0, second=0)
+                        compacted_hours.add((store['strings'][key[1]], hour))
+        
+        size = os.path.getsize(filename)
+        batch = []
+        with open(filename, 'rb') as f:
+            for log, bytes_read in iter_json_array(f, import_config['chunk_size']):
+                try:
+                    when = datetime.strptime(log['time'], '%Y-%m-%d %H:%M:%S').timestamp()
+                    # Checked here, so a bad row cannot fail a batch that is half inserted
+                    valid = (all(isinstance(log[field], str) for field in ('device', 'user', 'action'))
+                             and isinstance(log.get('room', ""), str) and log.get('status', 'requested') in LOG_STATUSES)
+                except (KeyError, TypeError, ValueError):
+                    valid = False
+                if not valid:
+                    counts['invalid'] += 1
+                    continue
+                if when < aggregate_cutoff:
+                    counts['expired'] += 1
+                    continue
+                if when < raw_cutoff and (log['device'], datetime.fromtimestamp(when).replace(minute=0, second=0)) in compacted_hours:
+                    counts['duplicates'] += 1
+                    continue
+                batch.append((when, log))
+                if len(batch) >= import_config['batch_size']:
+                    insert(batch)
+                    batch = []
+                    show_import_progress(f"Imported {counts['imported']} entries, {counts['duplicates']} duplicates skipped",
+                                         bytes_read / size if size else 1.0)
+        if batch:
+            insert(batch)
+        return counts
+    
+    def run_import(filename):
+        import_state['running'] = True
+        show_import_progress(f"Importing {filename}...", 0.0)
+        try:
+            counts = import_action_log(filename)
+        except (OSError, ValueError) as ex:
+            show_import_progress(f"Import failed: {ex}", 0.0)
+            add_notification(f"Import of {filename} failed: {ex}", "warning")
+        else:
+            show_import_progress(f"Imported {counts['imported']} entries, {counts['duplicates']} duplicates, "
+                                 f"{counts['expired']} past retention and {counts['invalid']} invalid skipped", 1.0)
+            add_notification(f"Imported {counts['imported']} log entries from {filename}", "success")
+        finally:
+            import_state['running'] = False
+        refresh_current_page()
+    
+    def get_camera_source(device_id, device):
+        return device.get('source') or f"synthetic:{device_id}"
+    
+    def create_camera_image(device_id, device, slot):
+        size = 'details' if slot == 'details' else 'card'
+        width, height = (640, 360) if size == 'details' else (280, 158)
+        key, encoded = get_thumbnail(get_camera_source(device_id, device), size)
+        image = ft.Image(src_base64=encoded or PLACEHOLDER_THUMBNAIL, width=width, height=height,
+                         fit=ft.ImageFit.COVER, border_radius=8, gapless_playback=True)
+        camera_views[(active_property['id'], device_id, slot)] = {'image': image, 'key': key}
+        return image
+    
+    def get_visible_cameras():
+        page_name = current_page_state['page']
+        if page_name == 'overview':
+            slot, candidates = 'overview', devices.items()
+        elif page_name.startswith('room_'):
+            room = page_name.split('_', 1)[1]
+            slot, candidates = 'room', [(device_id, device) for device_id, device in devices.items() if device['room'] == room]
+        elif page_name.startswith('details_'):
+            device_id = page_name.split('_', 1)[1]
+            slot, candidates = 'details', [(device_id, devices[device_id])] if device_id in devices else []
         else:
-            action = f"Set speed to {int(value)}"
+            return []
+        return [(device_id, device, slot) for device_id, device in candidates if device['type'] == 'camera' and device['state']]
+    
+    def camera_worker():
+        # Only cameras on the current page are watched, so hidden or disabled ones produce no frames
+        while not session_state['stopped']:
+            time.sleep(0.2)
+            changed = False
+            for device_id, device, slot in get_visible_cameras():
+                source = get_camera_source(device_id, device)
+                size = 'details' if slot == 'details' else 'card'
+                watch_camera(source, camera_session, camera_config[f"{size}_fps"], size)
+                key, encoded = get_thumbnail(source, size)
+                view = camera_views.get((active_property['id'], device_id, slot))
+                if view and key and view['key'] != key:
+                    view.update({'key': key})
+                    view['image'].src_base64 = encoded
+                    changed = True
+            if changed:
+                page.update()
+        # A pass still running at disconnect may have watched again, so clear once more on the way out
+        unwatch_session(camera_session)
+    
+    def end_session(e):
+        # The shared workers keep running for other sessions; only this page's own work stops
+        session_state['stopped'] = True
+        unwatch_session(camera_session)
+    
+    def run_replay(filename, speed):
+        with open(filename) as f:
+            logs = json.load(f)
+        if not isinstance(logs, list):
+            raise ValueError(f"{filename} does not hold a list of log entries")
+        logs.sort(key=lambda log: log['time'])
+        
+        sim_devices = {}
+        for log in logs:
+            if log['device'] not in sim_devices:
+                sim_devices[log['device']] = guess_device(log['device'], log)
+        start_simulation_property(sim_devices)
         
-        log_action(device_id, action)
+        def events():
+            first = datetime.strptime(logs[0]['time'], '%Y-%m-%d %H:%M:%S') if logs else None
+            for log in logs:
+                if log.get('status', 'requested') != 'requested':
+                    continue  # outcomes come from the simulated devices again
+                offset = (datetime.strptime(log['time'], '%Y-%m-%d %H:%M:%S') - first).total_seconds()
+                update = parse_action(log['action'])
+                if not update:
+                    continue
+                kind, value = event_for_update(sim_devices[log['device']], update)
+                if kind:
+                    # speed 0 replays as fast as possible
+                    yield (offset / speed if speed else 0), kind, log['device'], value
+        
+        started = time.perf_counter()
+        run_simulation_loop(events(), started)
+        finish_simulation(started)
     
     current_page_state = {'page': 'overview'}
     
+    # Persistent application shell and cached views
+    shell = {'root': None, 'theme': None, 'title': None, 'user': None, 'content': None, 'tabs': {}, 'active_tab': None}
+    # Both least recently used first, and capped so that visiting many pages and properties
+    # does not keep every control tree alive
+    view_cache = OrderedDict()  # (property id, page name) -> {'key': inputs the view was built from, 'view': control}
+    card_cache = OrderedDict()  # (property id, device id, show_room) -> {'signature': device values, 'card': control}
+    cache_limits = {'views': 32, 'cards': 2000}
+    stats_filters = {'device': "All", 'room': "All", 'user': "All"}
+    
     def refresh_current_page():
         page_name = current_page_state['page']
         if page_name == 'overview':
@@ -133,80 +1940,497 @@ def main(page: ft.Page):
             show_automation()
         elif page_name == 'notifications':
             show_notifications()
+        elif page_name == 'rooms':
+            show_rooms()
+        elif page_name == 'portfolio':
+            show_portfolio()
         elif page_name.startswith('details_'):
-            device_id = page_name.split('_')[1]
+            device_id = page_name.split('_', 1)[1]
             show_details(device_id)
         elif page_name.startswith('room_'):
             room = page_name.split('_', 1)[1]
             show_room(room)
     
-    def create_nav_bar(current_page_name):
+    def request_render(shard):
+        renders = api_state['renders']
+        renders[shard['id']] = renders.get(shard['id'], 0) + 1
+    
+    def publish_state_change(shard, device_id):
+        # Every device change goes to API subscribers and to the sessions showing its property
+        request_render(shard)
+        event = {'type': 'state', 'property': shard['id'], 'device': device_id,
+                 'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        event.update(shard['devices'][device_id])
+        for loop, queue, device_filter in list(state_subscribers):
+            if device_filter and device_id not in device_filter:
+                continue
+            loop.call_soon_threadsafe(queue_event, queue, event)
+    
+    def queue_event(queue, event):
+        # Slow subscribers lose events instead of growing memory
+        if not queue.full():
+            queue.put_nowait(event)
+    
+    def serialize_log(log):
+        return {
+            'time': log['time'].strftime('%Y-%m-%d %H:%M:%S'),
+            'device': log['device'],
+            'action': log['action'],
+            'user': log['user'],
+            'room': log['room'],
+            'status': log['status']
+        }
+    
+    def api_response(status, payload, keep_alive=True):
+        body = json.dumps(payload).encode()
+        head = (f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        return head.encode() + body
+    
+    def apply_api_update(shard, device_id, update):
+        if not isinstance(device_id, str) or device_id not in shard['devices']:
+            return {'device': device_id, 'error': 'Unknown device'}
+        if update.get('state') is not None and not isinstance(update['state'], bool):
+            return {'device': device_id, 'error': 'state must be true or false'}
+        try:
+            action = set_device_state(device_id, state=update.get('state'), value=update.get('value'),
+                                      user='api', shard=shard)
+        except (TypeError, ValueError) as ex:
+            return {'device': device_id, 'error': str(ex)}
+        return {'device': device_id, 'action': action, 'status': 'pending'}
+    
+    def validate_device_spec(device_id, spec):
+        # Checks a device posted with a new property; returns the problem, or None
+        if not isinstance(spec, dict):
+            return f"Device {device_id} must be an object"
+        if spec.get('type') not in ['light', 'door', 'camera', 'fan', 'thermostat']:
+            return f"Device {device_id} has an unknown type"
+        power = spec.get('power')
+        if isinstance(power, bool) or not isinstance(power, (int, float)) or power < 0:
+            return f"Device {device_id} needs a non-negative power"
+        if spec['type'] in ['light', 'door', 'camera']:
+            if not isinstance(spec.get('state'), bool):
+                return f"Device {device_id} needs a boolean state"
+        elif isinstance(spec.get('value'), bool) or not isinstance(spec.get('value'), (int, float)):
+            return f"Device {device_id} needs a numeric value"
+        return None
+    
+    def validate_rule_spec(rule, rule_devices):
+        # Checks an automation rule posted with a new property; returns the problem, or None
+        if not isinstance(rule, dict):
+            return "Rules must be objects"
+        if isinstance(rule.get('id'), bool) or not isinstance(rule.get('id'), (int, str)):
+            return "Rules need an id"
+        if not isinstance(rule.get('name'), str):
+            return f"Rule {rule['id']} needs a name"
+        try:
+            valid_time = datetime.strptime(rule.get('time'), '%H:%M').strftime('%H:%M') == rule['time']
+        except (TypeError, ValueError):
+            valid_time = False
+        if not valid_time:
+            return f"Rule {rule['id']} needs a time as HH:MM"
+        device = rule_devices.get(rule.get('device')) if isinstance(rule.get('device'), str) else None
+        if not device:
+            return f"Rule {rule['id']} refers to an unknown device"
+        try:
+            update = parse_action(rule.get('action')) if isinstance(rule.get('action'), str) else None
+        except ValueError:
+            update = None
+        if not update or ('state' in update) != ('state' in device):
+            return f"Rule {rule['id']} has an action its device does not support"
+        if not isinstance(rule.get('enabled'), bool):
+            return f"Rule {rule['id']} needs a boolean enabled"
+        return None
+    
+    def get_api_permission(method, parts):
+        if method == 'GET':
+            return 'view'
+        if parts[:1] == ['properties'] and len(parts) > 2:
+            parts = parts[2:]
+        return 'control' if parts[:1] == ['devices'] else 'manage'
+    
+    def route_api_request(method, target, body, session=None):
+        url = urlsplit(target)
+        parts = [part for part in url.path.split('/') if part]
+        
+        # Logging in is the only request that pays for the password hash
+        if parts == ['login'] and method == 'POST':
+            token = authenticate(body.get('username'), body.get('password')) if isinstance(body, dict) else None
+            if not token:
+                return '401 Unauthorized', {'error': 'Invalid username or password'}
+            return '200 OK', {'token': token, 'role': verify_session(token)['role'],
+                              'expires_in': auth_config['token_ttl']}
+        if not session:
+            return '401 Unauthorized', {'error': 'Missing or expired token'}
+        if parts == ['logout'] and method == 'POST':
+            revoke_session(session['token'])
+            return '200 OK', {'status': 'logged out'}
+        if not has_permission(session, get_api_permission(method, parts)):
+            return '403 Forbidden', {'error': f"Not allowed for role {session['role']}"}
+        
+        if parts == ['properties']:
+            if method == 'GET':
+                return '200 OK', {property_id: dict(shard['summary'], name=shard['name'], updated=str(shard['summary']['updated']))
+                                  for property_id, shard in properties.items()}
+            if method == 'POST':
+                if not isinstance(body, dict) or not isinstance(body.get('id'), str) or not body['id'] or body['id'] in properties:
+                    return '400 Bad Request', {'error': 'Expected a new property id'}
+                devices = body.get('devices', {})
+                if not isinstance(devices, dict):
+                    return '400 Bad Request', {'error': 'Expected devices as an object'}
+                for device_id, spec in devices.items():
+                    error = validate_device_spec(device_id, spec)
+                    if error:
+                        return '400 Bad Request', {'error': error}
+                    spec.setdefault('name', device_id)
+                    spec.setdefault('room', 'Unassigned')
+                rules = body.get('automation_rules', [])
+                if not isinstance(rules, list):
+                    return '400 Bad Request', {'error': 'Expected automation_rules as a list'}
+                for rule in rules:
+                    error = validate_rule_spec(rule, devices)
+                    if error:
+                        return '400 Bad Request', {'error': error}
+                if len({rule['id'] for rule in rules}) < len(rules):
+                    return '400 Bad Request', {'error': 'Rule ids must be unique'}
+                start_property(new_property(body['id'], body.get('name', body['id']), devices, automation_rules=rules))
+                return '200 OK', {'property': body['id']}
+            return '405 Method Not Allowed', {'error': 'Method not allowed'}
+        
+        # /properties/<id>/... addresses one property, other routes the default one
+        if len(parts) >= 2 and parts[0] == 'properties':
+            if parts[1] not in properties:
+                return '404 Not Found', {'error': 'Unknown property'}
+            shard = properties[parts[1]]
+            parts = parts[2:]
+        else:
+            shard = properties[api_config['default_property']]
+        devices = shard['devices']
+        
+        if parts == ['devices'] and method == 'GET':
+            return '200 OK', devices
+        
+        if parts == ['devices', 'bulk'] and method == 'POST':
+            # Body is either a list of updates or {"updates": [...]}
+            updates = body['updates'] if isinstance(body, dict) else body
+            if not isinstance(updates, list):
+                return '400 Bad Request', {'error': 'Expected a list of updates'}
+            results = [apply_api_update(shard, update.get('device'), update) for update in updates if isinstance(update, dict)]
+            return '200 OK', {'results': results}
+        
+        if len(parts) == 2 and parts[0] == 'devices':
+            device_id = parts[1]
+            if device_id not in devices:
+                return '404 Not Found', {'error': 'Unknown device'}
+            if method == 'GET':
+                return '200 OK', devices[device_id]
+            if method == 'POST':
+                if not isinstance(body, dict):
+                    return '400 Bad Request', {'error': 'Expected a JSON object'}
+                result = apply_api_update(shard, device_id, body)
+                return ('400 Bad Request' if 'error' in result else '200 OK'), result
+            return '405 Method Not Allowed', {'error': 'Method not allowed'}
+        
+        if parts == ['forecast'] and method == 'GET':
+            forecast = compute_forecast(shard)
+            return '200 OK', {key: forecast[key] for key in ('hours', 'total', 'devices', 'energy_kwh', 'elapsed_ms')}
+        
+        if parts == ['automation', 'dry-run'] and method == 'GET':
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            days = min(int(query.get('days', automation_config['dry_run_days'])), automation_config['max_api_dry_run_days'])
+            result = simulate_automation(shard, days)
+            return '200 OK', {**result, 'start': result['start'].isoformat(),
+                              'rules': {str(rule_id): stat for rule_id, stat in result['rules'].items()}}
+        
+        if parts == ['discover'] and method == 'POST':
+            if not isinstance(body, dict) or not isinstance(body.get('targets'), str) or not body['targets']:
+                return '400 Bad Request', {'error': 'Expected {"targets": "..."}'}
+            threading.Thread(target=run_discovery, args=(body['targets'], bool(body.get('simulate')), shard), daemon=True).start()
+            return '202 Accepted', {'status': 'started'}
+        
+        if parts == ['logs'] and method == 'GET':
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            limit = int(query.get('limit', 100))
+            with shard['lock']:
+                results = [serialize_log(log) for log in log_store_rows(
+                    shard['action_log'], query.get('device'), query.get('room'), query.get('user'), limit
+                )]
+            return '200 OK', {'logs': results}
+        
+        return '404 Not Found', {'error': 'Unknown endpoint'}
+    
+    async def read_ws_frame(reader):
+        header = await reader.readexactly(2)
+        opcode = header[0] & 0x0F
+        length = header[1] & 0x7F
+        if length == 126:
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(await reader.readexactly(8), 'big')
+        mask = await reader.readexactly(4) if header[1] & 0x80 else b''
+        payload = await reader.readexactly(length)
+        if mask:
+            payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        return opcode, payload
+    
+    def ws_frame(payload, opcode=0x1):
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, length])
+        elif length < 65536:
+            header = bytes([0x80 | opcode, 126]) + length.to_bytes(2, 'big')
+        else:
+            header = bytes([0x80 | opcode, 127]) + length.to_bytes(8, 'big')
+        return header + payload
+    
+    async def handle_websocket(reader, writer, headers):
+        accept = base64.b64encode(hashlib.sha1(
+            (headers['sec-websocket-key'] + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode()
+        ).digest()).decode()
+        writer.write((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+        ).encode())
+        
+        queue = asyncio.Queue(maxsize=1000)
+        device_filter = set()
+        subscriber = (asyncio.get_running_loop(), queue, device_filter)
+        state_subscribers.append(subscriber)
+        writer.write(ws_frame(json.dumps({
+            'type': 'snapshot',
+            'properties': {property_id: shard['devices'] for property_id, shard in properties.items()}
+        }).encode()))
+        
+        async def receive():
+            # Clients may send {"devices": [...]} to narrow the subscription
+            while True:
+                opcode, payload = await read_ws_frame(reader)
+                if opcode == 0x8:
+                    return
+                if opcode == 0x9:
+                    writer.write(ws_frame(payload, 0xA))
+                elif opcode == 0x1:
+                    try:
+                        requested = set(json.loads(payload).get('devices', []))
+                    except (ValueError, AttributeError, TypeError):
+                        continue
+                    device_filter.clear()
+                    device_filter.update(requested)
+        
+        receiver = asyncio.ensure_future(receive())
+        try:
+            while not receiver.done():
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait([getter, receiver], return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    break
+                writer.write(ws_frame(json.dumps(getter.result()).encode()))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            state_subscribers.remove(subscriber)
+            receiver.cancel()
+    
+    async def handle_api_connection(reader, writer):
+        try:
+            # Keep-alive: serve requests on this connection until the client closes it
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, header_value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = header_value.strip()
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    writer.write(api_response('400 Bad Request', {'error': 'Malformed request'}, False))
+                    break
+                
+                scheme, _, token = headers.get('authorization', '').partition(' ')
+                if scheme.lower() != 'bearer':
+                    token = None
+                
+                if headers.get('upgrade', '').lower() == 'websocket' and urlsplit(target).path == '/ws':
+                    # WebSocket clients cannot always set headers, so /ws also takes ?token=
+                    token = token or parse_qs(urlsplit(target).query).get('token', [None])[0]
+                    if not has_permission(verify_session(token), 'view'):
+                        writer.write(api_response('401 Unauthorized', {'error': 'Missing or expired token'}, False))
+                        break
+                    if not headers.get('sec-websocket-key'):
+                        writer.write(api_response('400 Bad Request', {'error': 'Missing Sec-WebSocket-Key'}, False))
+                        break
+                    await handle_websocket(reader, writer, headers)
+                    break
+                session = verify_session(token)
+                
+                keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+                if length > api_config['max_body']:
+                    writer.write(api_response('413 Payload Too Large', {'error': 'Body too large'}, False))
+                    break
+                raw_body = await reader.readexactly(length) if length else b''
+                
+                try:
+                    body = json.loads(raw_body) if raw_body else {}
+                    request = (method, target, body, session and dict(session, token=token))
+                    if urlsplit(target).path.rstrip('/').endswith(api_config['executor_routes']):
+                        status, payload = await asyncio.get_running_loop().run_in_executor(None, route_api_request, *request)
+                    else:
+                        status, payload = route_api_request(*request)
+                except (ValueError, KeyError, TypeError, AttributeError) as ex:
+                    # Bodies of the wrong shape fail somewhere in routing; the client still gets an answer
+                    status, payload = '400 Bad Request', {'error': str(ex)}
+                writer.write(api_response(status, payload, keep_alive))
+                
+                await writer.drain()
+                if not keep_alive:
+                    break
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    
+    def run_api_server():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(asyncio.start_server(
+                handle_api_connection, api_config['host'], api_config['port']
+            ))
+        except OSError as ex:
+            add_notification(f"Control API unavailable: {ex}", "warning")
+            return
+        add_notification(f"Control API listening on http://{api_config['host']}:{api_config['port']}", "success")
+        loop.run_forever()
+    
+    def ui_sync_worker():
+        # Changes made outside this session's handlers are rendered in batches, off the request path
+        rendered = {}
+        while not session_state['stopped']:
+            time.sleep(api_config['ui_sync_interval'])
+            page_name = current_page_state['page']
+            property_id = active_property['id']
+            renders = api_state['renders'].get(property_id, 0)
+            if rendered.get(property_id, 0) != renders and (page_name in ('overview', 'rooms') or page_name.startswith(('room_', 'details_'))):
+                rendered[property_id] = renders
+                refresh_current_page()
+    
+    def build_shell():
+        # The nav bar and layout are built once; navigation only swaps shell['content']
         colors = get_theme_colors()
+        shell['title'] = ft.Text("", color=colors['text'], size=16, weight=ft.FontWeight.BOLD)
+        shell['user'] = ft.Text("", color=colors['text_secondary'], size=14)
+        shell['content'] = ft.Container(padding=20, expand=True)
+        shell['tabs'] = {}
+        for tab, label, show in [
+            ("overview", "Overview", show_overview),
+            ("rooms", "Rooms", show_rooms),
+            ("statistics", "Statistics", show_statistics),
+            ("automation", "Automation", show_automation),
+            ("notifications", "Notifications", show_notifications),
+            ("portfolio", "Portfolio", show_portfolio),
+        ]:
+            shell['tabs'][tab] = ft.TextButton(
+                label,
+                on_click=lambda e, show=show: show(),
+                style=ft.ButtonStyle(color=colors['text_secondary'])
+            )
+        shell['active_tab'] = None
+        shell['theme'] = page.theme_mode
         
-        return ft.Container(
-            content=ft.Column([
-                ft.Container(
-                    content=ft.Row([
-                        ft.Text("🏠 Smart Home Pro", color=colors['text'], size=16, weight=ft.FontWeight.BOLD),
-                        ft.Row([
-                            ft.Text(f"👤 {current_user['username']}", color=colors['text_secondary'], size=14),
-                            ft.Switch(
-                                ref=dark_mode,
-                                label="🌙",
-                                value=page.theme_mode == ft.ThemeMode.DARK,
-                                on_change=toggle_theme,
-                                active_color=colors['accent']
-                            )
-                        ], spacing=10)
-                    ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
-                    padding=15,
-                    bgcolor=colors['nav'],
-                ),
-                ft.Container(
-                    content=ft.Row([
-                        ft.TextButton(
-                            "Overview",
-                            on_click=lambda e: show_overview(),
-                            style=ft.ButtonStyle(
-                                color=colors['accent'] if current_page_name == "overview" else colors['text_secondary']
-                            )
-                        ),
-                        ft.TextButton(
-                            "Rooms",
-                            on_click=lambda e: show_rooms(),
-                            style=ft.ButtonStyle(
-                                color=colors['accent'] if current_page_name == "rooms" else colors['text_secondary']
-                            )
-                        ),
-                        ft.TextButton(
-                            "Statistics",
-                            on_click=lambda e: show_statistics(),
-                            style=ft.ButtonStyle(
-                                color=colors['accent'] if current_page_name == "statistics" else colors['text_secondary']
-                            )
-                        ),
-                        ft.TextButton(
-                            "Automation",
-                            on_click=lambda e: show_automation(),
-                            style=ft.ButtonStyle(
-                                color=colors['accent'] if current_page_name == "automation" else colors['text_secondary']
-                            )
-                        ),
-                        ft.TextButton(
-                            "Notifications",
-                            on_click=lambda e: show_notifications(),
-                            style=ft.ButtonStyle(
-                                color=colors['accent'] if current_page_name == "notifications" else colors['text_secondary']
-                            )
-                        ),
-                    ], spacing=5),
-                    padding=ft.padding.only(left=15, right=15, bottom=10),
-                    bgcolor=colors['nav'],
-                    border=ft.border.only(bottom=ft.BorderSide(1, colors['border']))
-                ),
-            ], spacing=0),
-            bgcolor=colors['nav'],
-        )
+        shell['root'] = ft.Column([
+            ft.Container(
+                content=ft.Column([
+                    ft.Container(
+                        content=ft.Row([
+                            shell['title'],
+                            ft.Row([
+                                shell['user'],
+                                ft.Switch(
+                                    ref=dark_mode,
+                                    label="🌙",
+                                    value=page.theme_mode == ft.ThemeMode.DARK,
+                                    on_change=toggle_theme,
+                                    active_color=colors['accent']
+                                ),
+                                ft.TextButton("Logout", on_click=logout, style=ft.ButtonStyle(color=colors['accent'])),
+                            ], spacing=10)
+                        ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+                        padding=15,
+                        bgcolor=colors['nav'],
+                    ),
+                    ft.Container(
+                        content=ft.Row(list(shell['tabs'].values()), spacing=5),
+                        padding=ft.padding.only(left=15, right=15, bottom=10),
+                        bgcolor=colors['nav'],
+                        border=ft.border.only(bottom=ft.BorderSide(1, colors['border']))
+                    ),
+                ], spacing=0),
+                bgcolor=colors['nav'],
+            ),
+            shell['content'],
+        ], spacing=0, expand=True)
+        
+        page.clean()
+        page.add(shell['root'])
+    
+    def set_active_tab(tab):
+        if shell['active_tab'] == tab:
+            return
+        colors = get_theme_colors()
+        for name, button in shell['tabs'].items():
+            button.style.color = colors['accent'] if name == tab else colors['text_secondary']
+        shell['active_tab'] = tab
+    
+    def show_view(page_name, tab, build_view, cache_key=None, update_view=None):
+        current_page_state['page'] = page_name
+        page.bgcolor = get_theme_colors()['bg']
+        if shell['root'] is None or shell['theme'] != page.theme_mode:
+            build_shell()
+        set_active_tab(tab)
+        shell['title'].value = f"🏠 Smart Home Pro · {properties[active_property['id']]['name']}"
+        shell['user'].value = f"👤 {current_user['username']} ({current_user['role']})"
+        
+        # Reuse views already built for this property; only rebuild when their inputs changed
+        key = (active_property['id'], page_name)
+        cached = view_cache.get(key)
+        if cached and update_view:
+            update_view(cached['view'])
+        elif not cached or cached['key'] != cache_key:
+            cached = {'key': cache_key, 'view': build_view()}
+            view_cache[key] = cached
+        view_cache.move_to_end(key)
+        while len(view_cache) > cache_limits['views']:
+            view_cache.popitem(last=False)
+        shell['content'].content = cached['view']
+        page.update()
+    
+    def get_device_card(device_id, device, show_room=False):
+        # Cards are rebuilt only for devices whose state changed
+        key = (active_property['id'], device_id, show_room)
+        signature = (tuple(device.values()), device_id in properties[active_property['id']]['pending'])
+        cached = card_cache.get(key)
+        if not cached or cached['signature'] != signature:
+            cached = {'signature': signature, 'card': create_device_card(device_id, device, show_room)}
+            card_cache[key] = cached
+        card_cache.move_to_end(key)
+        while len(card_cache) > cache_limits['cards']:
+            card_cache.popitem(last=False)
+        return cached['card']
 
     def get_device_icon(device_type):
         icons = {
@@ -239,6 +2463,9 @@ def main(page: ft.Page):
     def create_device_card(device_id, device, show_room=False):
         colors = get_theme_colors()
         bgcolor = get_device_color(device['type'])
+        pending = device_id in properties[active_property['id']]['pending']
+        pending_text = ft.Text("⏳ Waiting for device..." if pending else "", size=11, color=colors['text_secondary'],
+                               visible=pending)
         
         if device['type'] in ['light', 'door', 'camera']:
             status = device['state']
@@ -256,6 +2483,8 @@ def main(page: ft.Page):
                 subtitle = "Tap to enable/disable"
             
             icon_text = get_device_icon(device['type'])
+            camera_image = create_camera_image(device_id, device, 'overview' if show_room else 'room') \
+                if device['type'] == 'camera' and status else None
             
             return ft.Container(
                 content=ft.Column([
@@ -268,9 +2497,11 @@ def main(page: ft.Page):
                         ], spacing=2, expand=True),
                     ], spacing=10),
                     ft.Divider(height=1, color=colors['border']),
+                    camera_image or ft.Container(),
                     ft.Text(f"Status: {status_text}", color=colors['text'], weight=ft.FontWeight.W_500),
                     ft.Text(subtitle, size=12, color=colors['text_secondary']),
                     ft.Text(f"Power: {device['power']}W", size=11, color=colors['text_secondary']),
+                    pending_text,
                     ft.Row([
                         ft.TextButton(
                             "Details",
@@ -325,6 +2556,7 @@ def main(page: ft.Page):
                     ft.Text(f"Current: {value_text}", color=colors['text'], weight=ft.FontWeight.W_500),
                     ft.Text(subtitle, size=12, color=colors['text_secondary']),
                     ft.Text(f"Power: {device['power']}W", size=11, color=colors['text_secondary']),
+                    pending_text,
                     ft.Slider(
                         min=min_val,
                         max=max_val,
@@ -354,8 +2586,14 @@ def main(page: ft.Page):
                 )
             )
     
+    def logout(e):
+        revoke_session(current_user['token'])
+        current_user.update({'username': None, 'role': None, 'token': None})
+        show_login()
+    
     def show_login():
         current_page_state['page'] = 'login'
+        shell['root'] = None
         colors = get_theme_colors()
         page.bgcolor = colors['bg']
         
@@ -379,9 +2617,10 @@ def main(page: ft.Page):
             username = username_field.value
             password = password_field.value
             
-            if username in users_db and users_db[username]['password'] == password:
-                current_user['username'] = username
-                current_user['role'] = users_db[username]['role']
+            token = authenticate(username, password)
+            if token:
+                session = verify_session(token)
+                current_user.update({'username': session['username'], 'role': session['role'], 'token': token})
                 add_notification(f"Welcome back, {username}!", "success")
                 show_overview()
             else:
@@ -434,91 +2673,97 @@ def main(page: ft.Page):
         page.update()
 
     def show_overview():
-        current_page_state['page'] = 'overview'
-        colors = get_theme_colors()
-        page.bgcolor = colors['bg']
-        
+        show_view('overview', 'overview', build_overview_view, update_view=update_overview_view)
+    
+    def get_overview_stats():
         # Calculate total power consumption
         total_power = 0
         active_devices = 0
         for device in devices.values():
-            if device['type'] in ['light', 'door', 'camera']:
-                if device['state']:
-                    total_power += device['power']
-                    active_devices += 1
-            else:
-                if device['value'] > 0:
-                    total_power += device['power'] * (device['value'] / (30 if device['type'] == 'thermostat' else 3))
-                    active_devices += 1
+            if is_device_active(device):
+                total_power += get_device_power(device)
+                active_devices += 1
+        return active_devices, total_power
+    
+    def update_overview_view(view):
+        active_devices, total_power = get_overview_stats()
+        view.data['active'].value = str(active_devices)
+        view.data['power'].value = f"{total_power:.0f}W"
+        view.data['total'].value = str(len(devices))
+        view.data['cards'].controls = [
+            get_device_card(device_id, device, show_room=True)
+            for device_id, device in devices.items()
+        ]
+    
+    def build_overview_view():
+        colors = get_theme_colors()
+        active_devices, total_power = get_overview_stats()
         
-        page.clean()
-        page.add(
-            ft.Column([
-                create_nav_bar("overview"),
+        active_text = ft.Text(str(active_devices), size=32, weight=ft.FontWeight.BOLD, color=colors['accent'])
+        power_text = ft.Text(f"{total_power:.0f}W", size=32, weight=ft.FontWeight.BOLD, color=colors['accent'])
+        total_text = ft.Text(str(len(devices)), size=32, weight=ft.FontWeight.BOLD, color=colors['accent'])
+        cards_row = ft.Row([
+            get_device_card(device_id, device, show_room=True)
+            for device_id, device in devices.items()
+        ], spacing=15, wrap=True, scroll=ft.ScrollMode.AUTO)
+        
+        return ft.Column([
+            ft.Text("Dashboard Overview", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
+            
+            # Stats cards
+            ft.Row([
                 ft.Container(
                     content=ft.Column([
-                        ft.Text("Dashboard Overview", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
-                        
-                        # Stats cards
-                        ft.Row([
-                            ft.Container(
-                                content=ft.Column([
-                                    ft.Text("Active Devices", size=14, color=colors['text_secondary']),
-                                    ft.Text(str(active_devices), size=32, weight=ft.FontWeight.BOLD, color=colors['accent']),
-                                ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
-                                padding=20,
-                                bgcolor=colors['card'],
-                                border_radius=12,
-                                expand=True,
-                                shadow=ft.BoxShadow(spread_radius=1, blur_radius=10, 
-                                                   color=ft.Colors.with_opacity(0.1, "#000000"))
-                            ),
-                            ft.Container(
-                                content=ft.Column([
-                                    ft.Text("Total Power", size=14, color=colors['text_secondary']),
-                                    ft.Text(f"{total_power:.0f}W", size=32, weight=ft.FontWeight.BOLD, color=colors['accent']),
-                                ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
-                                padding=20,
-                                bgcolor=colors['card'],
-                                border_radius=12,
-                                expand=True,
-                                shadow=ft.BoxShadow(spread_radius=1, blur_radius=10, 
-                                                   color=ft.Colors.with_opacity(0.1, "#000000"))
-                            ),
-                            ft.Container(
-                                content=ft.Column([
-                                    ft.Text("Total Devices", size=14, color=colors['text_secondary']),
-                                    ft.Text(str(len(devices)), size=32, weight=ft.FontWeight.BOLD, color=colors['accent']),
-                                ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
-                                padding=20,
-                                bgcolor=colors['card'],
-                                border_radius=12,
-                                expand=True,
-                                shadow=ft.BoxShadow(spread_radius=1, blur_radius=10, 
-                                                   color=ft.Colors.with_opacity(0.1, "#000000"))
-                            ),
-                        ], spacing=15),
-                        
-                        ft.Container(height=20),
-                        ft.Text("All Devices", size=22, weight=ft.FontWeight.BOLD, color=colors['text']),
-                        
-                        ft.Row([
-                            create_device_card(device_id, device, show_room=True)
-                            for device_id, device in devices.items()
-                        ], spacing=15, wrap=True, scroll=ft.ScrollMode.AUTO),
-                        
-                    ], spacing=15, scroll=ft.ScrollMode.AUTO),
+                        ft.Text("Active Devices", size=14, color=colors['text_secondary']),
+                        active_text,
+                    ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
                     padding=20,
+                    bgcolor=colors['card'],
+                    border_radius=12,
                     expand=True,
-                )
-            ], spacing=0, expand=True)
-        )
-        page.update()
+                    shadow=ft.BoxShadow(spread_radius=1, blur_radius=10, 
+                                       color=ft.Colors.with_opacity(0.1, "#000000"))
+                ),
+                ft.Container(
+                    content=ft.Column([
+                        ft.Text("Total Power", size=14, color=colors['text_secondary']),
+                        power_text,
+                    ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
+                    padding=20,
+                    bgcolor=colors['card'],
+                    border_radius=12,
+                    expand=True,
+                    shadow=ft.BoxShadow(spread_radius=1, blur_radius=10, 
+                                       color=ft.Colors.with_opacity(0.1, "#000000"))
+                ),
+                ft.Container(
+                    content=ft.Column([
+                        ft.Text("Total Devices", size=14, color=colors['text_secondary']),
+                        total_text,
+                    ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
+                    padding=20,
+                    bgcolor=colors['card'],
+                    border_radius=12,
+                    expand=True,
+                    shadow=ft.BoxShadow(spread_radius=1, blur_radius=10, 
+                                       color=ft.Colors.with_opacity(0.1, "#000000"))
+                ),
+            ], spacing=15),
+            
+            ft.Container(height=20),
+            ft.Text("All Devices", size=22, weight=ft.FontWeight.BOLD, color=colors['text']),
+            
+            cards_row,
+            
+        ], spacing=15, scroll=ft.ScrollMode.AUTO,
+           data={'active': active_text, 'power': power_text, 'total': total_text, 'cards': cards_row})
     
     def show_rooms():
-        current_page_state['page'] = 'rooms'
+        cache_key = tuple((device['room'], is_device_active(device)) for device in devices.values())
+        show_view('rooms', 'rooms', build_rooms_view, cache_key=cache_key)
+    
+    def build_rooms_view():
         colors = get_theme_colors()
-        page.bgcolor = colors['bg']
         
         # Group devices by room
         rooms = {}
@@ -531,9 +2776,7 @@ def main(page: ft.Page):
         room_cards = []
         for room, room_devices in rooms.items():
             device_count = len(room_devices)
-            active_count = sum(1 for _, d in room_devices 
-                             if (d['type'] in ['light', 'door', 'camera'] and d['state']) 
-                             or (d['type'] in ['thermostat', 'fan'] and d['value'] > 0))
+            active_count = sum(1 for _, d in room_devices if is_device_active(d))
             
             room_cards.append(
                 ft.Container(
@@ -558,106 +2801,189 @@ def main(page: ft.Page):
                 )
             )
         
-        page.clean()
-        page.add(
-            ft.Column([
-                create_nav_bar("rooms"),
-                ft.Container(
-                    content=ft.Column([
-                        ft.Text("Rooms", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
-                        ft.Text("Browse devices by room", size=16, color=colors['text_secondary']),
-                        ft.Container(height=10),
-                        ft.Row(room_cards, spacing=15, wrap=True, scroll=ft.ScrollMode.AUTO),
-                    ], spacing=15, scroll=ft.ScrollMode.AUTO),
-                    padding=20,
-                    expand=True,
-                )
-            ], spacing=0, expand=True)
+        discovery_field = ft.TextField(
+            label="Network segment",
+            hint_text="192.168.1.0/24 or host:port-port",
+            value=f"127.0.0.1:{discovery_config['simulator_port']}-{discovery_config['simulator_port'] + discovery_config['simulator_devices'] - 1}",
+            width=320
         )
-        page.update()
+        simulator_checkbox = ft.Checkbox(label="Start device simulator", value=True)
+        
+        def start_discovery(e):
+            if discovery_state['running'] or not authorize('manage'):
+                return
+            add_notification(f"Discovering devices on {discovery_field.value}...", "info")
+            threading.Thread(target=run_discovery, args=(discovery_field.value, simulator_checkbox.value), daemon=True).start()
+        
+        return ft.Column([
+            ft.Text("Rooms", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ft.Text("Browse devices by room", size=16, color=colors['text_secondary']),
+            ft.Row([
+                discovery_field,
+                simulator_checkbox,
+                ft.ElevatedButton(
+                    "Discover Devices",
+                    icon=ft.Icons.SEARCH,
+                    on_click=start_discovery,
+                    bgcolor=colors['accent'],
+                    color="#ffffff"
+                ),
+            ], spacing=15, wrap=True),
+            ft.Container(height=10),
+            ft.Row(room_cards, spacing=15, wrap=True, scroll=ft.ScrollMode.AUTO),
+        ], spacing=15, scroll=ft.ScrollMode.AUTO)
     
     def show_room(room_name):
-        current_page_state['page'] = f'room_{room_name}'
+        show_view(f'room_{room_name}', 'rooms', lambda: build_room_view(room_name),
+                  update_view=lambda view: update_room_view(view, room_name))
+    
+    def get_room_devices(room_name):
+        return [(device_id, device) for device_id, device in devices.items() 
+                if device['room'] == room_name]
+    
+    def update_room_view(view, room_name):
+        room_devices = get_room_devices(room_name)
+        view.data['count'].value = f"{len(room_devices)} devices in this room"
+        view.data['cards'].controls = [
+            get_device_card(device_id, device, show_room=False)
+            for device_id, device in room_devices
+        ]
+    
+    def build_room_view(room_name):
         colors = get_theme_colors()
-        page.bgcolor = colors['bg']
+        room_devices = get_room_devices(room_name)
+        
+        count_text = ft.Text(f"{len(room_devices)} devices in this room", 
+                             size=16, color=colors['text_secondary'])
+        cards_row = ft.Row([
+            get_device_card(device_id, device, show_room=False)
+            for device_id, device in room_devices
+        ], spacing=15, wrap=True, scroll=ft.ScrollMode.AUTO)
+        
+        return ft.Column([
+            ft.Row([
+                ft.IconButton(
+                    icon=ft.Icons.ARROW_BACK,
+                    on_click=lambda e: show_rooms(),
+                    icon_color=colors['accent']
+                ),
+                ft.Text(f"📍 {room_name}", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ], spacing=10),
+            count_text,
+            ft.Container(height=10),
+            cards_row,
+        ], spacing=15, scroll=ft.ScrollMode.AUTO, data={'count': count_text, 'cards': cards_row})
+
+    def show_statistics():
+        with log_lock:
+            log_key = (log_store_len(action_log), action_log['time'][-1] if log_store_len(action_log) else None,
+                       len(log_aggregates))
+        cache_key = (tuple(stats_filters.values()), log_key, tuple(energy_data), len(devices),
+                     properties[active_property['id']]['revision'], datetime.now().hour,
+                     simulation_state['running'], simulation_state['events'], id(simulation_state['result']))
+        show_view('statistics', 'statistics', build_statistics_view, cache_key=cache_key)
+    
+    def build_heatmap(heatmap, metric='on_seconds'):
+        colors = get_theme_colors()
+        values = heatmap[metric]
+        max_value = max(values) or 1
+        days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
         
-        room_devices = [(device_id, device) for device_id, device in devices.items() 
-                       if device['room'] == room_name]
+        def describe(value):
+            return f"{value / 3600:.1f}h active" if metric == 'on_seconds' else f"{int(value)} actions"
         
-        page.clean()
-        page.add(
-            ft.Column([
-                create_nav_bar("rooms"),
+        rows = [ft.Row([ft.Container(width=36)] + [
+            ft.Container(ft.Text(f"{hour:02d}" if hour % 3 == 0 else "", size=9, color=colors['text_secondary']), width=18)
+            for hour in range(24)
+        ], spacing=3)]
+        for day, name in enumerate(days):
+            rows.append(ft.Row([ft.Text(name, size=11, width=36, color=colors['text_secondary'])] + [
                 ft.Container(
-                    content=ft.Column([
-                        ft.Row([
-                            ft.IconButton(
-                                icon=ft.Icons.ARROW_BACK,
-                                on_click=lambda e: show_rooms(),
-                                icon_color=colors['accent']
-                            ),
-                            ft.Text(f"📍 {room_name}", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
-                        ], spacing=10),
-                        ft.Text(f"{len(room_devices)} devices in this room", 
-                               size=16, color=colors['text_secondary']),
-                        ft.Container(height=10),
-                        ft.Row([
-                            create_device_card(device_id, device, show_room=False)
-                            for device_id, device in room_devices
-                        ], spacing=15, wrap=True, scroll=ft.ScrollMode.AUTO),
-                    ], spacing=15, scroll=ft.ScrollMode.AUTO),
-                    padding=20,
-                    expand=True,
+                    width=18, height=18, border_radius=3,
+                    bgcolor=ft.Colors.with_opacity(round(0.1 + 0.9 * values[day * 24 + hour] / max_value, 2), colors['accent'])
+                    if values[day * 24 + hour] else colors['border'],
+                    tooltip=f"{name} {hour:02d}:00 - {describe(values[day * 24 + hour])}",
                 )
-            ], spacing=0, expand=True)
-        )
-        page.update()
-
-    def show_statistics():
-        current_page_state['page'] = 'statistics'
+                for hour in range(24)
+            ], spacing=3))
+        return ft.Column(rows, spacing=3)
+    
+    def build_statistics_view():
         colors = get_theme_colors()
-        page.bgcolor = colors['bg']
         
-        # Filter controls
-        filter_device = ft.Ref[ft.Dropdown]()
-        filter_room = ft.Ref[ft.Dropdown]()
-        filter_user = ft.Ref[ft.Dropdown]()
-        
-        def get_filtered_logs():
-            filtered = action_log.copy()
-            
-            if filter_device.current and filter_device.current.value and filter_device.current.value != "All":
-                filtered = [log for log in filtered if log['device'] == filter_device.current.value]
-            
-            if filter_room.current and filter_room.current.value and filter_room.current.value != "All":
-                filtered = [log for log in filtered if log['room'] == filter_room.current.value]
-            
-            if filter_user.current and filter_user.current.value and filter_user.current.value != "All":
-                filtered = [log for log in filtered if log['user'] == filter_user.current.value]
-            
-            return filtered
+        def get_filtered_logs(limit=None):
+            selected = {name: (None if value == "All" else value) for name, value in stats_filters.items()}
+            with log_lock:
+                return list(log_store_rows(action_log, selected['device'], selected['room'], selected['user'], limit))
         
         def apply_filters(e):
+            stats_filters[e.control.data] = e.control.value or "All"
             show_statistics()
         
         def export_logs(e):
             filtered = get_filtered_logs()
             filename = f"action_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
             with open(filename, 'w') as f:
-                json.dump([{
-                    'time': log['time'].strftime('%Y-%m-%d %H:%M:%S'),
-                    'device': log['device'],
-                    'action': log['action'],
-                    'user': log['user'],
-                    'room': log['room']
-                } for log in filtered], f, indent=2)
+                json.dump([serialize_log(log) for log in filtered], f, indent=2)
             add_notification(f"Logs exported to {filename}", "success")
             page.update()
         
+        import_file_field = ft.TextField(label="Import file", hint_text="action_log_YYYYmmdd_HHMMSS.json", width=320)
+        import_state['controls'] = {
+            'bar': ft.ProgressBar(value=import_state['progress'], width=320, color=colors['accent'], bgcolor=colors['border']),
+            'label': ft.Text(import_state['status'], size=12, color=colors['text_secondary']),
+        }
+        
+        def import_logs(e):
+            if import_state['running'] or not import_file_field.value or not authorize('manage'):
+                return
+            threading.Thread(target=run_import, args=(import_file_field.value.strip(),), daemon=True).start()
+        
+        # Device picker: only the top matches for what has been typed are sent to the page
+        device_suggestions = ft.Column([], spacing=0, visible=False)
+        
+        def select_device(e):
+            stats_filters['device'] = e.control.data
+            show_statistics()
+        
+        def search_devices(e):
+            shard = properties[active_property['id']]
+            with shard['lock']:
+                matches = search_index_query(shard['search'], e.control.value or "", device_search_config['limit'])
+            device_suggestions.controls = [
+                ft.TextButton(f"{name} ({device_id})", data=device_id, on_click=select_device,
+                              style=ft.ButtonStyle(color=colors['text']))
+                for device_id, name in matches
+            ]
+            device_suggestions.visible = bool(matches)
+            page.update()
+        
+        selected_device = stats_filters['device']
+        device_picker = ft.Column([
+            ft.Row([
+                ft.TextField(
+                    label="Device",
+                    hint_text="Search by name, id or room",
+                    value="" if selected_device == "All" else devices[selected_device]['name'] if selected_device in devices else selected_device,
+                    width=240,
+                    on_change=search_devices,
+                ),
+                ft.IconButton(icon=ft.Icons.CLEAR, data="All", on_click=select_device, icon_color=colors['accent'],
+                              tooltip="All devices"),
+            ], spacing=0),
+            device_suggestions,
+        ], spacing=4)
+        
         # Get unique values for filters
-        device_options = ["All"] + list(devices.keys())
         room_options = ["All"] + list(set(d['room'] for d in devices.values()))
-        user_options = ["All"] + list(set(log['user'] for log in action_log))
+        with log_lock:
+            user_options = ["All"] + log_store_users(action_log)
+        
+        # Heatmap follows the device filter, then the room filter, else the whole property
+        heatmap_device = stats_filters['device'] if stats_filters['device'] in devices else None
+        heatmap_room = None if heatmap_device or stats_filters['room'] == "All" else stats_filters['room']
+        usage_heatmap = get_heatmap_view(properties[active_property['id']], heatmap_device, heatmap_room)
+        heatmap_scope = heatmap_device and devices[heatmap_device]['name'] or heatmap_room or "All rooms"
         
         # Calculate energy consumption by hour
         hours = [f"{i:02d}:00" for i in range(24)]
@@ -682,164 +3008,378 @@ def main(page: ft.Page):
                 )
             )
         
+        # Forecast chart for the next 24 hours
+        forecast = compute_forecast(properties[active_property['id']])
+        max_forecast = max(forecast['total']) or 1
+        forecast_bars = []
+        for label, value in zip(forecast['hours'], forecast['total']):
+            forecast_bars.append(
+                ft.Container(
+                    content=ft.Column([
+                        ft.Container(
+                            bgcolor=ft.Colors.with_opacity(0.6, colors['accent']),
+                            width=20,
+                            height=(value / max_forecast) * 200,
+                            border_radius=4,
+                        ),
+                        ft.Text(label, size=8, color=colors['text_secondary'], rotate=ft.Rotate(angle=-0.5))
+                    ], horizontal_alignment=ft.CrossAxisAlignment.CENTER, spacing=5),
+                    tooltip=f"{label}: {value:.0f}W"
+                )
+            )
+        
         # Calculate total energy (kWh)
         total_energy_kwh = sum(energy_data) / 1000
         avg_power = sum(energy_data) / len(energy_data)
         peak_power = max(energy_data)
         
-        filtered_logs = get_filtered_logs()
+        filtered_logs = get_filtered_logs(limit=50)
         
-        page.clean()
-        page.add(
-            ft.Column([
-                create_nav_bar("statistics"),
+        # Load simulation controls
+        sim_devices_field = ft.TextField(label="Devices", value="100", width=120)
+        sim_rate_field = ft.TextField(label="Events/s", value="20", width=120)
+        sim_duration_field = ft.TextField(label="Seconds", value="30", width=120)
+        replay_file_field = ft.TextField(label="Replay file", hint_text="action_log_YYYYmmdd_HHMMSS.json", width=320)
+        replay_speed_field = ft.TextField(label="Speed (0 = max)", value="60", width=140)
+        
+        def start_load_generator(e):
+            if not authorize('manage'):
+                return
+            try:
+                args = (int(sim_devices_field.value), float(sim_rate_field.value), float(sim_duration_field.value))
+            except ValueError:
+                add_notification("Simulation settings must be numbers", "warning")
+                return
+            if args[0] < 1 or args[1] <= 0 or args[2] <= 0:
+                add_notification("Simulation needs at least one device and a positive rate and duration", "warning")
+                return
+            if begin_simulation('load'):
+                threading.Thread(target=run_load_generator_safely, args=args, daemon=True).start()
+        
+        def run_load_generator_safely(device_count, events_per_second, duration):
+            try:
+                run_load_generator(device_count, events_per_second, duration)
+            except (ValueError, IndexError, KeyError, ZeroDivisionError) as ex:
+                add_notification(f"Simulation failed: {ex!r}", "warning")
+            finally:
+                simulation_state['running'] = False
+        
+        def start_replay(e):
+            if not authorize('manage'):
+                return
+            try:
+                speed = float(replay_speed_field.value)
+            except ValueError:
+                add_notification("Replay speed must be a number", "warning")
+                return
+            if begin_simulation('replay'):
+                threading.Thread(target=run_replay_safely, args=(replay_file_field.value, speed), daemon=True).start()
+        
+        def run_replay_safely(filename, speed):
+            try:
+                run_replay(filename, speed)
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as ex:
+                add_notification(f"Replay failed: {ex!r}", "warning")
+            finally:
+                simulation_state['running'] = False
+        
+        def stop_simulation(e):
+            simulation_state['stop'] = True
+        
+        sim_result = simulation_state['result']
+        if simulation_state['running']:
+            sim_status = f"Running {simulation_state['mode']}: {simulation_state['events']} events so far"
+        elif sim_result:
+            sim_status = (f"Last {sim_result['mode']} run: {sim_result['events']} events on {sim_result['devices']} devices "
+                          f"at {sim_result['rate']:.0f}/s · latency p50 {sim_result['p50']:.1f}ms, "
+                          f"p95 {sim_result['p95']:.1f}ms, p99 {sim_result['p99']:.1f}ms, max {sim_result['max']:.1f}ms")
+        else:
+            sim_status = "No simulation run yet"
+        
+        # Long-term history from compacted aggregates
+        history_rows = []
+        for device_id, device in devices.items():
+            if stats_filters['device'] not in ("All", device_id):
+                continue
+            if stats_filters['room'] not in ("All", device['room']):
+                continue
+            summary = get_aggregate_summary(device_id=device_id)
+            if not summary['count']:
+                continue
+            longest_state = max(summary['durations'], key=summary['durations'].get) if summary['durations'] else "-"
+            history_rows.append(
+                ft.DataRow(cells=[
+                    ft.DataCell(ft.Text(device_id, color=colors['text'])),
+                    ft.DataCell(ft.Text(str(summary['count']), color=colors['text'])),
+                    ft.DataCell(ft.Text(f"{summary['first'].strftime('%Y-%m-%d')} - {summary['last'].strftime('%Y-%m-%d')}", color=colors['text'])),
+                    ft.DataCell(ft.Text(longest_state, color=colors['text'])),
+                ])
+            )
+        
+        return ft.Column([
+            ft.Text("Statistics & Analytics", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
+            
+            # Energy stats
+            ft.Row([
                 ft.Container(
                     content=ft.Column([
-                        ft.Text("Statistics & Analytics", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
-                        
-                        # Energy stats
-                        ft.Row([
-                            ft.Container(
-                                content=ft.Column([
-                                    ft.Text("Total Energy (24h)", size=12, color=colors['text_secondary']),
-                                    ft.Text(f"{total_energy_kwh:.2f} kWh", size=24, weight=ft.FontWeight.BOLD, color=colors['accent']),
-                                ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
-                                padding=15,
-                                bgcolor=colors['card'],
-                                border_radius=12,
-                                expand=True,
-                            ),
-                            ft.Container(
-                                content=ft.Column([
-                                    ft.Text("Average Power", size=12, color=colors['text_secondary']),
-                                    ft.Text(f"{avg_power:.0f}W", size=24, weight=ft.FontWeight.BOLD, color=colors['accent']),
-                                ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
-                                padding=15,
-                                bgcolor=colors['card'],
-                                border_radius=12,
-                                expand=True,
-                            ),
-                            ft.Container(
-                                content=ft.Column([
-                                    ft.Text("Peak Power", size=12, color=colors['text_secondary']),
-                                    ft.Text(f"{peak_power}W", size=24, weight=ft.FontWeight.BOLD, color=colors['accent']),
-                                ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
-                                padding=15,
-                                bgcolor=colors['card'],
-                                border_radius=12,
-                                expand=True,
-                            ),
-                        ], spacing=15),
-                        
-                        ft.Container(height=10),
-                        
-                        # Energy chart
-                        ft.Container(
-                            content=ft.Column([
-                                ft.Text("24-Hour Power Consumption", size=18, weight=ft.FontWeight.BOLD, color=colors['text']),
-                                ft.Container(
-                                    content=ft.Row(
-                                        chart_bars,
-                                        spacing=8,
-                                        scroll=ft.ScrollMode.AUTO,
-                                        alignment=ft.MainAxisAlignment.START
-                                    ),
-                                    padding=20,
-                                ),
-                            ], spacing=10),
-                            bgcolor=colors['card'],
-                            border_radius=12,
-                            padding=15,
-                        ),
-                        
-                        ft.Container(height=20),
-                        
-                        # Action log section
-                        ft.Row([
-                            ft.Text("Action Log", size=22, weight=ft.FontWeight.BOLD, color=colors['text']),
-                            ft.ElevatedButton(
-                                "Export",
-                                icon=ft.Icons.DOWNLOAD,
-                                on_click=export_logs,
-                                bgcolor=colors['accent'],
-                                color="#ffffff"
-                            )
-                        ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
-                        
-                        # Filters
-                        ft.Row([
-                            ft.Dropdown(
-                                ref=filter_device,
-                                label="Device",
-                                options=[ft.dropdown.Option(opt) for opt in device_options],
-                                value="All",
-                                width=200,
-                                on_change=apply_filters,
-                            ),
-                            ft.Dropdown(
-                                ref=filter_room,
-                                label="Room",
-                                options=[ft.dropdown.Option(opt) for opt in room_options],
-                                value="All",
-                                width=200,
-                                on_change=apply_filters,
-                            ),
-                            ft.Dropdown(
-                                ref=filter_user,
-                                label="User",
-                                options=[ft.dropdown.Option(opt) for opt in user_options],
-                                value="All",
-                                width=200,
-                                on_change=apply_filters,
-                            ),
-                        ], spacing=15, wrap=True),
-                        
-                        ft.Container(
-                            content=ft.Column([
-                                ft.DataTable(
-                                    columns=[
-                                        ft.DataColumn(ft.Text("Time", weight=ft.FontWeight.W_600, color=colors['text'])),
-                                        ft.DataColumn(ft.Text("Device", weight=ft.FontWeight.W_600, color=colors['text'])),
-                                        ft.DataColumn(ft.Text("Room", weight=ft.FontWeight.W_600, color=colors['text'])),
-                                        ft.DataColumn(ft.Text("Action", weight=ft.FontWeight.W_600, color=colors['text'])),
-                                        ft.DataColumn(ft.Text("User", weight=ft.FontWeight.W_600, color=colors['text'])),
-                                    ],
-                                    rows=[
-                                        ft.DataRow(cells=[
-                                            ft.DataCell(ft.Text(log['time'].strftime('%H:%M:%S'), color=colors['text'])),
-                                            ft.DataCell(ft.Text(log['device'], color=colors['text'])),
-                                            ft.DataCell(ft.Text(log['room'], color=colors['text'])),
-                                            ft.DataCell(ft.Text(log['action'], color=colors['text'])),
-                                            ft.DataCell(ft.Text(log['user'], color=colors['text'])),
-                                        ]) for log in filtered_logs[:50]
-                                    ],
-                                    border=ft.border.all(1, colors['border']),
-                                    border_radius=8,
-                                    heading_row_color=colors['card'],
-                                )
-                            ], scroll=ft.ScrollMode.AUTO, height=400),
-                            bgcolor=colors['card'],
-                            border_radius=12,
-                            padding=10,
-                        )
-                    ], spacing=15, scroll=ft.ScrollMode.AUTO),
-                    padding=20,
+                        ft.Text("Total Energy (24h)", size=12, color=colors['text_secondary']),
+                        ft.Text(f"{total_energy_kwh:.2f} kWh", size=24, weight=ft.FontWeight.BOLD, color=colors['accent']),
+                    ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
+                    padding=15,
+                    bgcolor=colors['card'],
+                    border_radius=12,
+                    expand=True,
+                ),
+                ft.Container(
+                    content=ft.Column([
+                        ft.Text("Average Power", size=12, color=colors['text_secondary']),
+                        ft.Text(f"{avg_power:.0f}W", size=24, weight=ft.FontWeight.BOLD, color=colors['accent']),
+                    ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
+                    padding=15,
+                    bgcolor=colors['card'],
+                    border_radius=12,
+                    expand=True,
+                ),
+                ft.Container(
+                    content=ft.Column([
+                        ft.Text("Peak Power", size=12, color=colors['text_secondary']),
+                        ft.Text(f"{peak_power}W", size=24, weight=ft.FontWeight.BOLD, color=colors['accent']),
+                    ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
+                    padding=15,
+                    bgcolor=colors['card'],
+                    border_radius=12,
                     expand=True,
+                ),
+            ], spacing=15),
+            
+            ft.Container(height=10),
+            
+            # Energy chart
+            ft.Container(
+                content=ft.Column([
+                    ft.Text("24-Hour Power Consumption", size=18, weight=ft.FontWeight.BOLD, color=colors['text']),
+                    ft.Container(
+                        content=ft.Row(
+                            chart_bars,
+                            spacing=8,
+                            scroll=ft.ScrollMode.AUTO,
+                            alignment=ft.MainAxisAlignment.START
+                        ),
+                        padding=20,
+                    ),
+                ], spacing=10),
+                bgcolor=colors['card'],
+                border_radius=12,
+                padding=15,
+            ),
+            
+            # Forecast chart
+            ft.Container(
+                content=ft.Column([
+                    ft.Row([
+                        ft.Text("Next 24 Hours Forecast", size=18, weight=ft.FontWeight.BOLD, color=colors['text']),
+                        ft.Text(f"{forecast['energy_kwh']:.2f} kWh projected", size=14, color=colors['accent']),
+                    ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+                    ft.Text(f"From current states, enabled rules and hourly usage history · computed in {forecast['elapsed_ms']:.1f}ms",
+                           size=12, color=colors['text_secondary']),
+                    ft.Container(
+                        content=ft.Row(
+                            forecast_bars,
+                            spacing=8,
+                            scroll=ft.ScrollMode.AUTO,
+                            alignment=ft.MainAxisAlignment.START
+                        ),
+                        padding=20,
+                    ),
+                ], spacing=10),
+                bgcolor=colors['card'],
+                border_radius=12,
+                padding=15,
+            ),
+            
+            ft.Container(height=20),
+            
+            # Action log section
+            ft.Row([
+                ft.Text("Action Log", size=22, weight=ft.FontWeight.BOLD, color=colors['text']),
+                ft.ElevatedButton(
+                    "Export",
+                    icon=ft.Icons.DOWNLOAD,
+                    on_click=export_logs,
+                    bgcolor=colors['accent'],
+                    color="#ffffff"
                 )
-            ], spacing=0, expand=True)
-        )
-        page.update()
+            ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+            
+            # Import of earlier exports
+            ft.Row([
+                import_file_field,
+                ft.ElevatedButton("Import", icon=ft.Icons.UPLOAD, on_click=import_logs,
+                                  bgcolor=colors['accent'], color="#ffffff"),
+                ft.Column([import_state['controls']['bar'], import_state['controls']['label']], spacing=4),
+            ], spacing=15, wrap=True),
+            
+            # Filters
+            ft.Row([
+                device_picker,
+                ft.Dropdown(
+                    label="Room",
+                    options=[ft.dropdown.Option(opt) for opt in room_options],
+                    value=stats_filters['room'],
+                    data='room',
+                    width=200,
+                    on_change=apply_filters,
+                ),
+                ft.Dropdown(
+                    label="User",
+                    options=[ft.dropdown.Option(opt) for opt in user_options],
+                    value=stats_filters['user'],
+                    data='user',
+                    width=200,
+                    on_change=apply_filters,
+                ),
+            ], spacing=15, wrap=True),
+            
+            ft.Container(
+                content=ft.Column([
+                    ft.DataTable(
+                        columns=[
+                            ft.DataColumn(ft.Text("Time", weight=ft.FontWeight.W_600, color=colors['text'])),
+                            ft.DataColumn(ft.Text("Device", weight=ft.FontWeight.W_600, color=colors['text'])),
+                            ft.DataColumn(ft.Text("Room", weight=ft.FontWeight.W_600, color=colors['text'])),
+                            ft.DataColumn(ft.Text("Action", weight=ft.FontWeight.W_600, color=colors['text'])),
+                            ft.DataColumn(ft.Text("User", weight=ft.FontWeight.W_600, color=colors['text'])),
+                        ],
+                        rows=[
+                            ft.DataRow(cells=[
+                                ft.DataCell(ft.Text(log['time'].strftime('%H:%M:%S'), color=colors['text'])),
+                                ft.DataCell(ft.Text(log['device'], color=colors['text'])),
+                                ft.DataCell(ft.Text(log['room'], color=colors['text'])),
+                                ft.DataCell(ft.Text(log['action'] if log['status'] == 'requested' else f"{log['action']} ({log['status']})",
+                                                    color=colors['text'])),
+                                ft.DataCell(ft.Text(log['user'], color=colors['text'])),
+                            ]) for log in filtered_logs
+                        ],
+                        border=ft.border.all(1, colors['border']),
+                        border_radius=8,
+                        heading_row_color=colors['card'],
+                    )
+                ], scroll=ft.ScrollMode.AUTO, height=400),
+                bgcolor=colors['card'],
+                border_radius=12,
+                padding=10,
+            ),
+            
+            ft.Container(height=20),
+            
+            # Usage heatmap section
+            ft.Text("Usage Heatmap", size=22, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ft.Text(f"{heatmap_scope}: active time and actions by day of week and hour",
+                   size=12, color=colors['text_secondary']),
+            ft.Container(
+                content=ft.Column([
+                    ft.Text("Active time", weight=ft.FontWeight.W_600, color=colors['text']),
+                    build_heatmap(usage_heatmap, 'on_seconds'),
+                    ft.Text("Actions", weight=ft.FontWeight.W_600, color=colors['text']),
+                    build_heatmap(usage_heatmap, 'actions'),
+                ], spacing=10, scroll=ft.ScrollMode.AUTO),
+                bgcolor=colors['card'],
+                border_radius=12,
+                padding=20,
+            ),
+            
+            ft.Container(height=20),
+            
+            # Compacted history section
+            ft.Text("Long-term History", size=22, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ft.Text(f"Entries older than {retention['raw_days']} days are compacted into hourly summaries",
+                   size=12, color=colors['text_secondary']),
+            ft.Container(
+                content=ft.DataTable(
+                    columns=[
+                        ft.DataColumn(ft.Text("Device", weight=ft.FontWeight.W_600, color=colors['text'])),
+                        ft.DataColumn(ft.Text("Actions", weight=ft.FontWeight.W_600, color=colors['text'])),
+                        ft.DataColumn(ft.Text("Period", weight=ft.FontWeight.W_600, color=colors['text'])),
+                        ft.DataColumn(ft.Text("Longest State", weight=ft.FontWeight.W_600, color=colors['text'])),
+                    ],
+                    rows=history_rows,
+                    border=ft.border.all(1, colors['border']),
+                    border_radius=8,
+                    heading_row_color=colors['card'],
+                ) if history_rows else ft.Text("No compacted history yet", color=colors['text_secondary']),
+                bgcolor=colors['card'],
+                border_radius=12,
+                padding=10,
+            ),
+            
+            ft.Container(height=20),
+            
+            # Load simulation section
+            ft.Text("Load Simulation", size=22, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ft.Text("Runs in a separate \"Load Simulation\" property and measures event-to-render latency",
+                   size=12, color=colors['text_secondary']),
+            ft.Container(
+                content=ft.Column([
+                    ft.Row([
+                        sim_devices_field,
+                        sim_rate_field,
+                        sim_duration_field,
+                        ft.ElevatedButton("Generate Load", on_click=start_load_generator,
+                                          bgcolor=colors['accent'], color="#ffffff"),
+                    ], spacing=15, wrap=True),
+                    ft.Row([
+                        replay_file_field,
+                        replay_speed_field,
+                        ft.ElevatedButton("Replay", on_click=start_replay,
+                                          bgcolor=colors['accent'], color="#ffffff"),
+                        ft.TextButton("Stop", on_click=stop_simulation,
+                                      style=ft.ButtonStyle(color=colors['accent'])),
+                    ], spacing=15, wrap=True),
+                    ft.Text(sim_status, color=colors['text_secondary']),
+                ], spacing=15),
+                bgcolor=colors['card'],
+                border_radius=12,
+                padding=15,
+            ),
+        ], spacing=15, scroll=ft.ScrollMode.AUTO)
 
     def show_details(device_id):
-        current_page_state['page'] = f'details_{device_id}'
-        colors = get_theme_colors()
-        page.bgcolor = colors['bg']
-        
         if device_id not in devices:
             return
+        with log_lock:
+            log_key = (log_store_len(action_log), action_log['time'][-1] if log_store_len(action_log) else None,
+                       len(log_aggregates))
+        cache_key = (tuple(devices[device_id].values()), log_key,
+                     properties[active_property['id']]['revision'], datetime.now().hour)
+        show_view(f'details_{device_id}', 'details', lambda: build_details_view(device_id), cache_key=cache_key)
+    
+    def build_details_view(device_id):
+        colors = get_theme_colors()
         
         device = devices[device_id]
-        device_actions = [log for log in action_log if log['device'] == device_id]
+        with log_lock:
+            device_actions = list(log_store_rows(action_log, device=device_id, limit=10))
+        history = get_aggregate_summary(device_id=device_id)
+        usage_heatmap = get_heatmap_view(properties[active_property['id']], device_id=device_id)
+        forecast = compute_forecast(properties[active_property['id']])
+        device_forecast = forecast['devices'].get(device_id, [0.0])
+        peak_slot = max(range(len(device_forecast)), key=device_forecast.__getitem__)
+        forecast_text = ft.Text(
+            f"Next 24h forecast: {sum(device_forecast) / 1000:.2f} kWh, peak {device_forecast[peak_slot]:.0f}W at {forecast['hours'][peak_slot]}",
+            color=colors['text']
+        )
+        history_items = [
+            ft.Text(f"{history['count']} actions from {history['first'].strftime('%Y-%m-%d')} to {history['last'].strftime('%Y-%m-%d')}",
+                   color=colors['text'])
+        ] if history['count'] else [
+            ft.Text("No compacted history yet", color=colors['text_secondary'])
+        ]
+        for action, count in sorted(history['actions'].items(), key=lambda item: item[1], reverse=True):
+            hours_in_state = history['durations'].get(action, 0) / 3600
+            history_items.append(
+                ft.Text(f"{action}: {count}x, {hours_in_state:.1f}h in state", color=colors['text_secondary'])
+            )
         
         if device['type'] in ['light', 'door', 'camera']:
             if device['type'] == 'light':
@@ -857,74 +3397,160 @@ def main(page: ft.Page):
                 value_text = f"Speed {int(value)}"
             state_display = ft.Text(f"Value: {value_text}", color=colors['text'], size=16)
         
-        page.clean()
-        page.add(
-            ft.Column([
-                create_nav_bar("details"),
-                ft.Container(
-                    content=ft.Column([
-                        ft.Row([
-                            ft.IconButton(
-                                icon=ft.Icons.ARROW_BACK,
-                                on_click=lambda e: show_overview(),
-                                icon_color=colors['accent']
-                            ),
-                            ft.Text(f"{get_device_icon(device['type'])} {device['name']}", 
-                                   size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
-                        ], spacing=10),
-                        
-                        ft.Container(
-                            content=ft.Column([
-                                ft.Text("Device Information", size=18, weight=ft.FontWeight.BOLD, color=colors['text']),
-                                ft.Divider(color=colors['border']),
-                                ft.Text(f"ID: {device_id}", color=colors['text']),
-                                ft.Text(f"Type: {device['type'].title()}", color=colors['text']),
-                                ft.Text(f"Room: {device['room']}", color=colors['text']),
-                                ft.Text(f"Power Consumption: {device['power']}W", color=colors['text']),
-                                state_display,
-                            ], spacing=10),
-                            padding=20,
-                            bgcolor=colors['card'],
-                            border_radius=12,
-                        ),
-                        
-                        ft.Container(height=10),
-                        
-                        ft.Text("Recent Actions", size=20, weight=ft.FontWeight.BOLD, color=colors['text']),
-                        ft.Container(
-                            content=ft.Column([
-                                ft.Text(f"{log['time'].strftime('%Y-%m-%d %H:%M:%S')} - {log['action']} by {log['user']}", 
-                                       color=colors['text'])
-                                for log in device_actions[:10]
-                            ] if device_actions else [
-                                ft.Text("No recent actions", color=colors['text_secondary'])
-                            ], spacing=8),
-                            padding=20,
-                            bgcolor=colors['card'],
-                            border_radius=12,
-                        ),
-                    ], spacing=15, scroll=ft.ScrollMode.AUTO),
-                    padding=20,
-                    expand=True,
-                )
-            ], spacing=0, expand=True)
-        )
-        page.update()
+        return ft.Column([
+            ft.Row([
+                ft.IconButton(
+                    icon=ft.Icons.ARROW_BACK,
+                    on_click=lambda e: show_overview(),
+                    icon_color=colors['accent']
+                ),
+                ft.Text(f"{get_device_icon(device['type'])} {device['name']}", 
+                       size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ], spacing=10),
+            
+            ft.Container(
+                content=ft.Column([
+                    ft.Text("Device Information", size=18, weight=ft.FontWeight.BOLD, color=colors['text']),
+                    ft.Divider(color=colors['border']),
+                    ft.Text(f"ID: {device_id}", color=colors['text']),
+                    ft.Text(f"Type: {device['type'].title()}", color=colors['text']),
+                    ft.Text(f"Room: {device['room']}", color=colors['text']),
+                    ft.Text(f"Power Consumption: {device['power']}W", color=colors['text']),
+                    ft.Text(f"Address: {device['address']}", color=colors['text']) if device.get('address') else ft.Container(),
+                    state_display,
+                    forecast_text,
+                ], spacing=10),
+                padding=20,
+                bgcolor=colors['card'],
+                border_radius=12,
+            ),
+            
+            ft.Container(
+                content=create_camera_image(device_id, device, 'details') if device['state'] else
+                ft.Text("Camera is disabled", color=colors['text_secondary']),
+                padding=20,
+                bgcolor=colors['card'],
+                border_radius=12,
+            ) if device['type'] == 'camera' else ft.Container(),
+            
+            ft.Container(height=10),
+            
+            ft.Text("Recent Actions", size=20, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ft.Container(
+                content=ft.Column([
+                    ft.Text(f"{log['time'].strftime('%Y-%m-%d %H:%M:%S')} - {log['action']} by {log['user']}"
+                            + ("" if log['status'] == 'requested' else f" ({log['status']})"), 
+                           color=colors['text'])
+                    for log in device_actions[:10]
+                ] if device_actions else [
+                    ft.Text("No recent actions", color=colors['text_secondary'])
+                ], spacing=8),
+                padding=20,
+                bgcolor=colors['card'],
+                border_radius=12,
+            ),
+            
+            ft.Text("Long-term History", size=20, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ft.Container(
+                content=ft.Column(history_items, spacing=8),
+                padding=20,
+                bgcolor=colors['card'],
+                border_radius=12,
+            ),
+            
+            ft.Text("Usage Heatmap", size=20, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ft.Container(
+                content=ft.Column([
+                    ft.Text("Active time by day of week and hour", color=colors['text_secondary']),
+                    build_heatmap(usage_heatmap, 'on_seconds'),
+                ], spacing=8),
+                padding=20,
+                bgcolor=colors['card'],
+                border_radius=12,
+            ),
+        ], spacing=15, scroll=ft.ScrollMode.AUTO)
     
     def show_automation():
-        current_page_state['page'] = 'automation'
+        cache_key = (tuple((rule['id'], rule['enabled']) for rule in automation_rules),
+                     active_property['id'], id(properties[active_property['id']]['dry_run']), dry_run_state['running'])
+        show_view('automation', 'automation', build_automation_view, cache_key=cache_key)
+    
+    def build_automation_view():
         colors = get_theme_colors()
-        page.bgcolor = colors['bg']
         
         def toggle_rule(e):
             rule_id = e.control.data
+            if not authorize('manage'):
+                e.control.value = not e.control.value
+                page.update()
+                return
             for rule in automation_rules:
                 if rule['id'] == rule_id:
                     rule['enabled'] = not rule['enabled']
+                    properties[active_property['id']]['revision'] += 1
                     add_notification(f"Rule '{rule['name']}' {'enabled' if rule['enabled'] else 'disabled'}", "info")
                     break
             show_automation()
         
+        dry_run_days = ft.TextField(label="Days", value=str(automation_config['dry_run_days']), width=120,
+                                    keyboard_type=ft.KeyboardType.NUMBER)
+        
+        def run_dry_run(e):
+            if dry_run_state['running']:
+                return
+            try:
+                days = int(dry_run_days.value)
+            except ValueError:
+                add_notification("Dry run needs a whole number of days", "warning")
+                page.update()
+                return
+            dry_run_state['running'] = True
+            threading.Thread(target=run_dry_run_in_background, args=(properties[active_property['id']], days), daemon=True).start()
+            show_automation()
+        
+        dry_run = properties[active_property['id']]['dry_run']
+        dry_run_items = []
+        if dry_run_state['running']:
+            dry_run_items.append(ft.Text("Dry run in progress...", color=colors['text_secondary']))
+        if dry_run:
+            dry_run_items.append(ft.Text(
+                f"{dry_run['days']} days, {dry_run['events']} rule runs simulated in {dry_run['elapsed_ms']:.0f}ms - "
+                f"projected energy {dry_run['energy_kwh']:.1f} kWh", color=colors['text']))
+            rule_names = {rule['id']: rule['name'] for rule in automation_rules}
+            for conflict in dry_run['conflicts'][:20]:
+                dry_run_items.append(ft.Text(
+                    f"⚠️ Conflict on {devices[conflict['device']]['name'] if conflict['device'] in devices else conflict['device']} "
+                    f"at {conflict['time']}: {', '.join(conflict['rules'])} ({conflict['count']}x)", color=colors['text']))
+            for rule_id, stat in dry_run['rules'].items():
+                if stat['runs'] and stat['redundant'] == stat['runs']:
+                    dry_run_items.append(ft.Text(
+                        f"Redundant: '{rule_names.get(rule_id, rule_id)}' never changes its device", color=colors['text_secondary']))
+            dry_run_items.append(ft.DataTable(
+                columns=[
+                    ft.DataColumn(ft.Text("Device", weight=ft.FontWeight.W_600, color=colors['text'])),
+                    ft.DataColumn(ft.Text("On-hours", weight=ft.FontWeight.W_600, color=colors['text']), numeric=True),
+                    ft.DataColumn(ft.Text("Energy (kWh)", weight=ft.FontWeight.W_600, color=colors['text']), numeric=True),
+                    ft.DataColumn(ft.Text("Conflicts", weight=ft.FontWeight.W_600, color=colors['text']), numeric=True),
+                    ft.DataColumn(ft.Text("Redundant runs", weight=ft.FontWeight.W_600, color=colors['text']), numeric=True),
+                ],
+                rows=[
+                    ft.DataRow(cells=[
+                        ft.DataCell(ft.Text(devices[device_id]['name'] if device_id in devices else device_id, color=colors['text'])),
+                        ft.DataCell(ft.Text(f"{stat['on_hours']:.0f}", color=colors['text'])),
+                        ft.DataCell(ft.Text(f"{stat['energy_kwh']:.1f}", color=colors['text'])),
+                        ft.DataCell(ft.Text(str(stat['conflicts']), color=colors['text'])),
+                        ft.DataCell(ft.Text(str(stat['redundant']), color=colors['text'])),
+                    ])
+                    for device_id, stat in sorted(dry_run['devices'].items(), key=lambda item: item[1]['energy_kwh'],
+                                                  reverse=True)[:50]
+                ],
+                border=ft.border.all(1, colors['border']),
+                border_radius=8,
+                heading_row_color=colors['card'],
+            ))
+        else:
+            dry_run_items.append(ft.Text("Not run yet", color=colors['text_secondary']))
+        
         rule_cards = []
         for rule in automation_rules:
             rule_cards.append(
@@ -950,28 +3576,37 @@ def main(page: ft.Page):
                 )
             )
         
-        page.clean()
-        page.add(
-            ft.Column([
-                create_nav_bar("automation"),
-                ft.Container(
-                    content=ft.Column([
-                        ft.Text("Automation Rules", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
-                        ft.Text("Schedule and automate your devices", size=16, color=colors['text_secondary']),
-                        ft.Container(height=10),
-                        ft.Row(rule_cards, spacing=15, wrap=True, scroll=ft.ScrollMode.AUTO),
-                    ], spacing=15, scroll=ft.ScrollMode.AUTO),
-                    padding=20,
-                    expand=True,
-                )
-            ], spacing=0, expand=True)
-        )
-        page.update()
+        return ft.Column([
+            ft.Text("Automation Rules", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ft.Text("Schedule and automate your devices", size=16, color=colors['text_secondary']),
+            ft.Container(height=10),
+            ft.Row(rule_cards, spacing=15, wrap=True, scroll=ft.ScrollMode.AUTO),
+            
+            ft.Container(height=10),
+            ft.Text("Dry Run", size=22, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ft.Text("Fast-forwards the enabled rules from the current device states to find rules that fight over a device "
+                    "or never change anything, and projects on-hours and energy", size=12, color=colors['text_secondary']),
+            ft.Container(
+                content=ft.Column([
+                    ft.Row([
+                        dry_run_days,
+                        ft.ElevatedButton("Run", on_click=run_dry_run, bgcolor=colors['accent'], color="#ffffff"),
+                    ], spacing=10),
+                    *dry_run_items,
+                ], spacing=10),
+                bgcolor=colors['card'],
+                border_radius=12,
+                padding=20,
+            ),
+        ], spacing=15, scroll=ft.ScrollMode.AUTO)
     
     def show_notifications():
-        current_page_state['page'] = 'notifications'
+        cache_key = (len(notifications), notifications[0]['time'] if notifications else None,
+                     sum(dropped_notifications.values()))
+        show_view('notifications', 'notifications', build_notifications_view, cache_key=cache_key)
+    
+    def build_notifications_view():
         colors = get_theme_colors()
-        page.bgcolor = colors['bg']
         
         def clear_notifications(e):
             notifications.clear()
@@ -997,38 +3632,127 @@ def main(page: ft.Page):
                 )
             )
         
-        page.clean()
-        page.add(
-            ft.Column([
-                create_nav_bar("notifications"),
+        return ft.Column([
+            ft.Row([
+                ft.Text("Notifications", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
+                ft.ElevatedButton(
+                    "Clear All",
+                    on_click=clear_notifications,
+                    bgcolor=colors['accent'],
+                    color="#ffffff"
+                )
+            ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+            ft.Text(f"{sum(dropped_notifications.values())} older notifications dropped",
+                   size=12, color=colors['text_secondary']) if any(dropped_notifications.values()) else ft.Container(),
+            ft.Container(height=10),
+            ft.Column(
+                notification_items if notifications else [
+                    ft.Text("No notifications", color=colors['text_secondary'], size=16)
+                ],
+                spacing=10,
+                scroll=ft.ScrollMode.AUTO
+            ),
+        ], spacing=15, scroll=ft.ScrollMode.AUTO)
+    
+    def show_portfolio():
+        cache_key = tuple((property_id, shard['summary']['updated']) for property_id, shard in list(properties.items()))
+        show_view('portfolio', 'portfolio', build_portfolio_view, cache_key=cache_key)
+    
+    def build_portfolio_view():
+        colors = get_theme_colors()
+        
+        # Read only the summaries the property workers precomputed
+        summaries = [(property_id, shard['name'], shard['summary']) for property_id, shard in list(properties.items())]
+        total_devices = sum(summary['devices'] for _, _, summary in summaries)
+        total_active = sum(summary['active'] for _, _, summary in summaries)
+        total_power = sum(summary['power'] for _, _, summary in summaries)
+        total_alerts = sum(summary['alerts'] for _, _, summary in summaries)
+        
+        # Properties needing attention first
+        summaries.sort(key=lambda item: (-item[2]['alerts'], -item[2]['power']))
+        shown = summaries[:100]
+        
+        def stat_card(label, value):
+            return ft.Container(
+                content=ft.Column([
+                    ft.Text(label, size=14, color=colors['text_secondary']),
+                    ft.Text(value, size=32, weight=ft.FontWeight.BOLD, color=colors['accent']),
+                ], horizontal_alignment=ft.CrossAxisAlignment.CENTER),
+                padding=20,
+                bgcolor=colors['card'],
+                border_radius=12,
+                expand=True,
+                shadow=ft.BoxShadow(spread_radius=1, blur_radius=10, 
+                                   color=ft.Colors.with_opacity(0.1, "#000000"))
+            )
+        
+        property_cards = []
+        for property_id, name, summary in shown:
+            property_cards.append(
                 ft.Container(
                     content=ft.Column([
-                        ft.Row([
-                            ft.Text("Notifications", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
-                            ft.ElevatedButton(
-                                "Clear All",
-                                on_click=clear_notifications,
-                                bgcolor=colors['accent'],
-                                color="#ffffff"
-                            )
-                        ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
-                        ft.Container(height=10),
-                        ft.Column(
-                            notification_items if notifications else [
-                                ft.Text("No notifications", color=colors['text_secondary'], size=16)
-                            ],
-                            spacing=10,
-                            scroll=ft.ScrollMode.AUTO
-                        ),
-                    ], spacing=15, scroll=ft.ScrollMode.AUTO),
+                        ft.Text(f"🏢 {name}", size=18, weight=ft.FontWeight.BOLD, color=colors['text']),
+                        ft.Text(f"{summary['active']}/{summary['devices']} devices active", size=14, color=colors['text_secondary']),
+                        ft.Text(f"{summary['power']:.0f}W", size=14, color=colors['accent']),
+                        ft.Text(f"⚠️ {summary['alerts']} alerts" if summary['alerts'] else "No alerts",
+                               size=14, color=colors['text_secondary']),
+                        ft.ElevatedButton(
+                            "Open" if property_id != active_property['id'] else "Current",
+                            data=property_id,
+                            on_click=lambda e: switch_property(e.control.data),
+                            bgcolor=colors['accent'],
+                            color="#ffffff"
+                        )
+                    ], spacing=8),
                     padding=20,
-                    expand=True,
+                    bgcolor=colors['card'],
+                    border_radius=12,
+                    width=240,
                 )
-            ], spacing=0, expand=True)
-        )
-        page.update()
+            )
+        
+        return ft.Column([
+            ft.Text("Portfolio Overview", size=28, weight=ft.FontWeight.BOLD, color=colors['text']),
+            ft.Text(f"{len(summaries)} properties", size=16, color=colors['text_secondary']),
+            ft.Row([
+                stat_card("Active Devices", f"{total_active}/{total_devices}"),
+                stat_card("Total Power", f"{total_power:.0f}W"),
+                stat_card("Alerts", str(total_alerts)),
+            ], spacing=15),
+            ft.Container(height=10),
+            ft.Row(property_cards, spacing=15, wrap=True),
+            ft.Text(f"Showing {len(shown)} of {len(summaries)} properties", size=12, color=colors['text_secondary'])
+            if len(shown) < len(summaries) else ft.Container(),
+        ], spacing=15, scroll=ft.ScrollMode.AUTO)
+    
+    with shared_state['lock']:
+        first_session = not shared_state['started']
+        shared_state['started'] = True
+    if first_session:
+        # Restore persisted heatmaps and history before the workers start; one saver writes
+        # the state file for the whole process
+        load_state()
+        threading.Thread(target=state_saver, daemon=True).start()
+        
+        # Each property runs its scheduler, compaction and summaries on its own worker
+        for property_shard in list(properties.values()):
+            start_property(property_shard)
+        
+        # Acknowledge, retry or revert device commands in the background
+        device_transport['send'] = simulated_send
+        threading.Thread(target=command_worker, daemon=True).start()
+        
+        # Serve the local control API, bound once for the whole process
+        if api_config['enabled']:
+            threading.Thread(target=run_api_server, daemon=True).start()
+    
+    # This page's own workers stop when it disconnects
+    threading.Thread(target=ui_sync_worker, daemon=True).start()
+    threading.Thread(target=camera_worker, daemon=True).start()
+    page.on_disconnect = end_session
+    page.on_close = end_session
     
-    # Initialize with overview page
-    show_overview()
+    # Start at the login page
+    show_login()
 
 ft.app(target=main)